@@ -0,0 +1,604 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, event, text
+from werkzeug.serving import make_server
+
+from flaskr import create_app, encode_cursor
+from models import db, init_db, notify_change, Category, Question
+
+'''
+benchmark
+    reproducible load benchmark of every /api/v1 endpoint. Generates a
+    synthetic question bank of a given size and category skew, drives each
+    route through the Flask test client and over real HTTP at set
+    concurrency levels, reports throughput, latency percentiles, queries,
+    rows fetched and allocations per request, times cold starts of the app in
+    fresh interpreters, and compares the results with a saved baseline.
+
+    python benchmark.py --questions 100000 --concurrency 1,8 \
+        --save-baseline baseline.json
+    python benchmark.py --questions 100000 --concurrency 1,8 \
+        --baseline baseline.json
+
+    The benchmark database is wiped and regenerated on every run, never point
+    --database-url at a database holding real questions.
+'''
+
+VOCABULARY_SIZE = 2000
+WORDS_PER_QUESTION = 8
+INSERT_BATCH_SIZE = 5000
+# Questions removed per bulk delete request, and the requests sent
+BULK_DELETE_IDS = 5
+BULK_DELETE_REQUESTS = 20
+# Requests whose allocations are traced, per scenario
+TRACED_REQUESTS = 20
+# Cold starts measured, each in a fresh interpreter
+STARTUP_RUNS = 5
+STARTUP_KEY = 'startup'
+# Run by measure_startup() in a fresh interpreter, prints the phase timings
+STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+from flaskr import create_app
+imported = time.perf_counter()
+connections = []
+event.listen(Pool, 'connect', lambda *args: connections.append(1))
+app = create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1]})
+created = time.perf_counter()
+opened = len(connections)
+status = app.test_client().get('/api/v1/categories').status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'startup_connections': opened,
+    'status': status
+}))
+'''
+# Relative slowdown or throughput drop reported as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+def word(number):
+    return f'w{number:04d}'
+
+
+def category_weights(categories, skew):
+    ''' Returns Zipf weights of the categories, uniform when skew is 0 '''
+    return [1 / (rank ** skew) for rank in range(1, categories + 1)]
+
+
+def generate_bank(database_url, questions, categories=6, skew=1.0, seed=0):
+    ''' Replaces the contents of database_url with a synthetic question bank.
+
+    Question text is drawn from a fixed vocabulary so searches have a
+    predictable number of matches, categories follow category_weights().
+    '''
+    engine = create_engine(database_url)
+    db.metadata.drop_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text('DROP TABLE IF EXISTS schema_version'))
+    engine.dispose()
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url,
+                      'SQLALCHEMY_TRACK_MODIFICATIONS': False})
+    init_db(app)
+    rng = random.Random(seed)
+    category_ids = list(range(1, categories + 1))
+    weights = category_weights(categories, skew)
+
+    with app.app_context():
+        db.session.execute(Category.__table__.insert(), [
+            {'id': category_id, 'type': f'Category {category_id}'}
+            for category_id in category_ids
+        ])
+        for start in range(0, questions, INSERT_BATCH_SIZE):
+            size = min(INSERT_BATCH_SIZE, questions - start)
+            db.session.execute(Question.__table__.insert(), [{
+                'question': ' '.join(
+                    word(rng.randrange(VOCABULARY_SIZE))
+                    for _ in range(WORDS_PER_QUESTION)),
+                'answer': word(rng.randrange(VOCABULARY_SIZE)),
+                'category': category,
+                'difficulty': rng.randint(1, 5)
+            } for category in rng.choices(category_ids, weights, k=size)])
+            db.session.commit()
+        notify_change(None, 'reset')
+
+    return app
+
+
+class Scenario:
+    ''' One route under load: builds its requests and reads their responses '''
+
+    def __init__(self, name, build, max_requests=None, record=None,
+                 headers=None):
+        self.name = name
+        self.build = build
+        self.max_requests = max_requests
+        self.record = record
+        self.headers = headers
+
+
+def scenarios(app, questions, categories):
+    ''' Returns the benchmarked scenarios of app, covering every /api/v1
+    route
+    '''
+    pages = max(1, questions // 10)
+    created = []
+    lock = threading.Lock()
+
+    def record_created(response):
+        with lock:
+            created.append(response['created'])
+
+    def delete_created(rng):
+        with lock:
+            question_id = created.pop() if created else 0
+        return 'DELETE', f'/api/v1/questions/{question_id}', None
+
+    def bulk_delete_inserted(rng):
+        # Requests are built before they are timed, the questions each one
+        # deletes are inserted here so delete_question keeps the ones
+        # create_question made
+        with app.app_context():
+            question_ids = Question.insert_many([{
+                'question': 'Benchmark sweep question',
+                'answer': 'Benchmark answer',
+                'category': rng.randint(1, categories),
+                'difficulty': rng.randint(1, 5)
+            } for _ in range(BULK_DELETE_IDS)])
+        ids = ','.join(str(question_id) for question_id in question_ids)
+        return 'DELETE', f'/api/v1/questions?ids={ids}', None
+
+    def quiz(rng, session=False):
+        body = {
+            'previous_questions': rng.sample(range(1, questions + 1),
+                                             min(5, questions)),
+            'quiz_category': {'id': rng.randint(0, categories),
+                              'type': 'Any'}
+        }
+        if session:
+            body['session'] = True
+        return 'POST', '/api/v1/quizzes', body
+
+    return [
+        Scenario('categories',
+                 lambda rng: ('GET', '/api/v1/categories', None)),
+        Scenario('questions_page',
+                 lambda rng: ('GET',
+                              f'/api/v1/questions?page='
+                              f'{rng.randint(1, pages)}', None)),
+        Scenario('questions_page_fields',
+                 lambda rng: ('GET',
+                              f'/api/v1/questions?page='
+                              f'{rng.randint(1, pages)}'
+                              f'&fields=id,question,category', None)),
+        Scenario('questions_page_gzip',
+                 lambda rng: ('GET',
+                              f'/api/v1/questions?page='
+                              f'{rng.randint(1, pages)}', None),
+                 headers={'Accept-Encoding': 'gzip'}),
+        Scenario('questions_cursor',
+                 lambda rng: ('GET',
+                              f'/api/v1/questions?limit=100&after='
+                              f'{encode_cursor(rng.randint(0, questions))}',
+                              None)),
+        Scenario('category_page',
+                 lambda rng: ('GET',
+                              f'/api/v1/categories/'
+                              f'{rng.randint(1, categories)}/questions?page='
+                              f'{rng.randint(1, 10)}', None)),
+        Scenario('search',
+                 lambda rng: ('POST', '/api/v1/questions', {
+                     'searchTerm': word(rng.randrange(VOCABULARY_SIZE))
+                 })),
+        Scenario('quiz', quiz),
+        Scenario('quiz_session', lambda rng: quiz(rng, session=True)),
+        Scenario('quiz_filtered',
+                 lambda rng: ('POST', '/api/v1/quizzes', {
+                     'previous_questions': [],
+                     'categories': rng.sample(range(1, categories + 1),
+                                              min(2, categories)),
+                     'min_difficulty': 3,
+                     'max_difficulty': 5
+                 })),
+        Scenario('create_question',
+                 lambda rng: ('POST', '/api/v1/questions', {
+                     'question': 'Benchmark question',
+                     'answer': 'Benchmark answer',
+                     'category': rng.randint(1, categories),
+                     'difficulty': rng.randint(1, 5)
+                 }),
+                 record=record_created),
+        Scenario('delete_question', delete_created),
+        Scenario('bulk_delete_questions', bulk_delete_inserted,
+                 max_requests=BULK_DELETE_REQUESTS),
+        Scenario('export',
+                 lambda rng: ('GET', '/api/v1/questions/export', None),
+                 max_requests=3),
+    ]
+
+
+class QueryCounter:
+    ''' Counts the statements run and the rows fetched through an engine '''
+
+    def __init__(self, engine):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.rows = 0
+        event.listen(engine, 'after_execute', self._after_execute)
+
+    def reset(self):
+        with self._lock:
+            self.queries = 0
+            self.rows = 0
+
+    def _count(self, rows):
+        with self._lock:
+            self.rows += rows
+
+    def _after_execute(self, connection, clause, multiparams, params, result):
+        with self._lock:
+            self.queries += 1
+
+        # Wrap the result's fetch methods, so rows are counted as they are
+        # read whichever way the caller iterates. Buffered results implement
+        # some fetch methods with others, only the outermost call counts.
+        depth = [0]
+
+        def counting(fetch):
+            def wrapper(*args):
+                depth[0] += 1
+                try:
+                    rows = fetch(*args)
+                finally:
+                    depth[0] -= 1
+                if depth[0] == 0:
+                    if isinstance(rows, list):
+                        self._count(len(rows))
+                    elif rows is not None:
+                        self._count(1)
+                return rows
+            return wrapper
+
+        for name in ('_fetchone_impl', '_fetchmany_impl', '_fetchall_impl'):
+            setattr(result, name, counting(getattr(result, name)))
+
+
+def client_sender(app):
+    ''' Returns a send(method, path, body, headers) going through the test
+    client
+    '''
+    local = threading.local()
+
+    def send(method, path, body, headers=None):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        response = client.open(path, method=method, json=body,
+                               headers=headers)
+        data = response.get_data()
+        return response.status_code, data
+
+    return send
+
+
+def http_sender(base_url):
+    ''' Returns a send(method, path, body, headers) making real HTTP requests.
+
+    Compressed bodies are returned as they came over the wire.
+    '''
+    def send(method, path, body, headers=None):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        request = urllib.request.Request(
+            base_url + path, data=data, method=method,
+            headers={'Content-Type': 'application/json', **(headers or {})})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+    return send
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def run_scenario(scenario, send, requests, concurrency, counter, seed=0):
+    ''' Sends requests requests of scenario from concurrency threads.
+
+    Returns:
+        A dict of throughput, latency percentiles in milliseconds, error
+        count, queries and rows fetched and response bytes per request.
+    '''
+    requests = min(requests, scenario.max_requests or requests)
+    rng = random.Random(seed)
+    calls = [scenario.build(rng) for _ in range(requests)]
+    latencies = []
+    sizes = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def one(call):
+        started = time.perf_counter()
+        status, data = send(*call, scenario.headers)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            sizes.append(len(data))
+            # Not found is a valid answer, e.g. for a search without matches
+            if status >= 400 and status != 404:
+                errors[0] += 1
+        if scenario.record is not None and status == 200:
+            scenario.record(json.loads(data))
+
+    counter.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, calls))
+    wall = time.perf_counter() - started
+
+    return {
+        'requests': requests,
+        'errors': errors[0],
+        'throughput': requests / wall,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'queries': counter.queries / requests,
+        'rows': counter.rows / requests,
+        'bytes': statistics.mean(sizes),
+    }
+
+
+def traced_allocations(scenario, send, requests=TRACED_REQUESTS, seed=0):
+    ''' Returns the mean peak of memory allocated per request, in KiB '''
+    rng = random.Random(seed)
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(requests, scenario.max_requests or requests)):
+            call = scenario.build(rng)
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            status, data = send(*call, scenario.headers)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+            if scenario.record is not None and status == 200:
+                scenario.record(json.loads(data))
+    finally:
+        tracemalloc.stop()
+    return statistics.mean(peaks) / 1024
+
+
+def serve(app):
+    ''' Serves app over HTTP on a free local port from a background thread.
+
+    Returns:
+        The server, stop it with shutdown(), and its base URL.
+    '''
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def run(app, questions, categories, modes=('client', 'http'),
+        concurrency=(1,), requests=200, seed=0):
+    ''' Runs every scenario in every mode and concurrency level.
+
+    Every create_question run is followed by a delete_question run removing
+    the questions it created, and bulk_delete_questions removes the ones it
+    inserts itself, so the bank keeps its size.
+
+    Returns:
+        Results keyed by "<scenario>/<mode>/c<concurrency>".
+    '''
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+
+    results = {}
+    server = None
+    try:
+        for mode in modes:
+            if mode == 'http':
+                server, base_url = serve(app)
+                send = http_sender(base_url)
+            else:
+                send = client_sender(app)
+
+            for scenario in scenarios(app, questions, categories):
+                for level in concurrency:
+                    result = run_scenario(scenario, send, requests, level,
+                                          counter, seed)
+                    if mode == 'client' and level == concurrency[0]:
+                        result['alloc_kib'] = traced_allocations(
+                            scenario, send, seed=seed)
+                    results[f'{scenario.name}/{mode}/c{level}'] = result
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    return results
+
+
+def measure_startup(database_url, runs=STARTUP_RUNS):
+    ''' Measures cold starts of the app, each in a fresh interpreter.
+
+    Returns:
+        The median milliseconds spent importing flaskr, in create_app() and
+        serving the first request, and the connections opened before that
+        request, which should be none.
+    '''
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT, database_url],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, check=True, text=True).stdout
+        samples.append(json.loads(output))
+
+    result = {
+        metric: statistics.median(sample[metric] for sample in samples)
+        for metric in ('import_ms', 'create_app_ms', 'first_request_ms')
+    }
+    result['startup_connections'] = max(
+        sample['startup_connections'] for sample in samples)
+    result['errors'] = sum(sample['status'] != 200 for sample in samples)
+    return result
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    ''' Returns human readable regressions of results against baseline.
+
+    Latency, allocations and response sizes may grow, and throughput drop, by
+    tolerance before being reported. Queries and rows fetched per request are
+    deterministic, so any increase is a regression.
+    '''
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if key == STARTUP_KEY:
+            for metric in ('import_ms', 'create_app_ms', 'first_request_ms'):
+                if result[metric] > before[metric] * (1 + tolerance):
+                    regressions.append(
+                        f'{key} {metric} {before[metric]:.2f} -> '
+                        f'{result[metric]:.2f}')
+            if result['startup_connections'] > before['startup_connections']:
+                regressions.append(
+                    f'{key} startup_connections '
+                    f'{before["startup_connections"]} -> '
+                    f'{result["startup_connections"]}')
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'alloc_kib', 'bytes'):
+            if metric in result and metric in before and \
+                    result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(
+                    f'{key} {metric} {before[metric]:.2f} -> '
+                    f'{result[metric]:.2f}')
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(
+                f'{key} throughput {before["throughput"]:.1f} -> '
+                f'{result["throughput"]:.1f}')
+        for metric in ('queries', 'rows'):
+            if result[metric] > before[metric] + 1e-9:
+                regressions.append(
+                    f'{key} {metric} {before[metric]:.1f} -> '
+                    f'{result[metric]:.1f}')
+    return regressions
+
+
+def format_report(results):
+    lines = [
+        f'{"scenario":<36}{"req/s":>10}{"p50 ms":>9}{"p95 ms":>9}'
+        f'{"p99 ms":>9}{"queries":>9}{"rows":>9}{"bytes":>9}{"KiB":>9}'
+        f'{"errors":>8}'
+    ]
+    for key, result in results.items():
+        if key == STARTUP_KEY:
+            continue
+        alloc = result.get('alloc_kib')
+        lines.append(
+            f'{key:<36}{result["throughput"]:>10.1f}{result["p50_ms"]:>9.2f}'
+            f'{result["p95_ms"]:>9.2f}{result["p99_ms"]:>9.2f}'
+            f'{result["queries"]:>9.1f}{result["rows"]:>9.1f}'
+            f'{result["bytes"]:>9.0f}'
+            f'{"" if alloc is None else format(alloc, ".1f"):>9}'
+            f'{result["errors"]:>8}')
+
+    startup = results.get(STARTUP_KEY)
+    if startup is not None:
+        lines.append(
+            f'startup: import {startup["import_ms"]:.1f} ms, create_app '
+            f'{startup["create_app_ms"]:.1f} ms, first request '
+            f'{startup["first_request_ms"]:.1f} ms, '
+            f'{startup["startup_connections"]} connections before it')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark every /api/v1 endpoint on a synthetic bank.')
+    parser.add_argument(
+        '--database-url',
+        help='database to generate the bank into, it is wiped first '
+             '(default: a SQLite file in the temp directory)')
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=6)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent of the category sizes, 0 for '
+                             'equal sizes')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario and concurrency level')
+    parser.add_argument('--concurrency', default='1,8',
+                        help='comma separated concurrency levels')
+    parser.add_argument('--modes', default='client,http',
+                        help='comma separated: client, http')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--startup-runs', type=int, default=STARTUP_RUNS,
+                        help='cold starts to measure, 0 to skip')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--save-baseline',
+                        help='write the results as the new baseline')
+    parser.add_argument('--baseline', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'trivia_benchmark.db')
+
+    started = time.perf_counter()
+    app = generate_bank(database_url, args.questions, args.categories,
+                        args.skew, args.seed)
+    print(f'Generated {args.questions} questions in '
+          f'{time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+    results = run(app, args.questions, args.categories,
+                  modes=tuple(args.modes.split(',')),
+                  concurrency=tuple(
+                      int(level) for level in args.concurrency.split(',')),
+                  requests=args.requests, seed=args.seed)
+    if args.startup_runs:
+        results[STARTUP_KEY] = measure_startup(database_url,
+                                               args.startup_runs)
+    print(format_report(results))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import select
+import threading
+import uuid
+
+from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
+
+from models import db, notify_change, on_change
+
+'''
+change_feed
+    shares the writes committed by one worker with every other worker of the
+    app, so their in-process caches (categories, quiz index, snapshot, search
+    index, page cache and bank revision) stay current.
+
+    Every committed model write is published as an event naming its table,
+    action, row id and revision, plus the written record when it fits. Each
+    worker applies the events of the others through notify_change(), which
+    patches its caches in place. An event without its record makes the
+    worker reset the caches of that table instead.
+
+    ChangeFeed is an in-process bus for tests and single process servers,
+    PostgresChangeFeed carries the events over LISTEN/NOTIFY.
+'''
+
+logger = logging.getLogger(__name__)
+
+# Identifies the events published by this process
+ORIGIN = uuid.uuid4().hex[:12]
+DEFAULT_CHANNEL = 'trivia_changes'
+# PostgreSQL rejects NOTIFY payloads of 8000 bytes or more
+MAX_PAYLOAD_BYTES = 7900
+# Seconds between checks for a stop request, and before reconnecting
+POLL_INTERVAL = 1.0
+RECONNECT_DELAY = 1.0
+
+_CHANNEL_NAME = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+
+class ChangeFeed:
+    ''' In-process change feed: published events are handed synchronously to
+    every subscriber of the same feed.
+    '''
+
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, handler):
+        ''' Registers handler(events), called with lists of event dicts '''
+        self._subscribers.append(handler)
+        return handler
+
+    def start(self, app):
+        ''' Starts delivering events, app gives the database to use '''
+
+    def stop(self):
+        pass
+
+    def publish(self, events):
+        self.deliver(events)
+
+    def deliver(self, events):
+        for handler in list(self._subscribers):
+            handler(events)
+
+
+class PostgresChangeFeed(ChangeFeed):
+    ''' Change feed carried by PostgreSQL LISTEN/NOTIFY on channel.
+
+    publish() only queues the events. A publisher thread sends everything
+    queued with as few NOTIFY statements as fit, and a listener thread holds
+    a dedicated connection LISTENing on channel. Both start on start(). After
+    every (re)connection of the listener the subscribers get a reset event,
+    as notifications sent while it was away are lost.
+    '''
+
+    def __init__(self, channel=DEFAULT_CHANNEL):
+        super().__init__()
+        if not _CHANNEL_NAME.match(channel):
+            raise ValueError(f'Invalid channel name: {channel}')
+        self.channel = channel
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._engine = None
+
+    def start(self, app):
+        if self._threads:
+            return
+        self._engine = db.get_engine(app)
+        self._stopping.clear()
+        listening = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._listen, args=(listening,),
+                             name='change-feed-listener', daemon=True),
+            threading.Thread(target=self._publish_queued,
+                             name='change-feed-publisher', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        # Writes made before the listener is ready would go unnoticed
+        listening.wait(POLL_INTERVAL * 5)
+
+    def stop(self):
+        if not self._threads:
+            return
+        self._stopping.set()
+        self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def publish(self, events):
+        self._queue.put(events)
+
+    def _payloads(self, events):
+        ''' Yields the JSON payloads of events, packed under MAX_PAYLOAD_BYTES
+        each. Records too large to fit are left out of their events.
+        '''
+        chunk = []
+        size = 2
+        for event in events:
+            encoded = json.dumps(event, separators=(',', ':'))
+            if len(encoded.encode('utf-8')) + 2 > MAX_PAYLOAD_BYTES:
+                event = dict(event, record=None, previous=None)
+                encoded = json.dumps(event, separators=(',', ':'))
+            length = len(encoded.encode('utf-8')) + 1
+            if chunk and size + length > MAX_PAYLOAD_BYTES:
+                yield '[' + ','.join(chunk) + ']'
+                chunk = []
+                size = 2
+            chunk.append(encoded)
+            size += length
+        if chunk:
+            yield '[' + ','.join(chunk) + ']'
+
+    def _publish_queued(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            events = list(batch)
+            # Drain whatever else is waiting into the same statement batch
+            while True:
+                try:
+                    batch = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if batch is None:
+                    self._queue.put(None)
+                    break
+                events.extend(batch)
+
+            try:
+                with self._engine.begin() as connection:
+                    for payload in self._payloads(events):
+                        connection.execute(
+                            text('SELECT pg_notify(:channel, :payload)'),
+                            channel=self.channel, payload=payload)
+            except Exception:
+                logger.exception('Could not publish %d changes', len(events))
+
+    def _listen(self, listening):
+        while not self._stopping.is_set():
+            try:
+                connection = self._engine.raw_connection()
+            except Exception:
+                logger.exception('Change feed cannot connect')
+                self._stopping.wait(RECONNECT_DELAY)
+                continue
+
+            # Kept out of the pool, it stays in autocommit mode
+            connection.detach()
+            dbapi_connection = connection.connection
+            try:
+                # Ends the transaction the pool's connect hooks may have begun
+                dbapi_connection.rollback()
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.channel}')
+                self.deliver([reset_event()])
+                listening.set()
+
+                while not self._stopping.is_set():
+                    readable, _, _ = select.select([dbapi_connection], [], [],
+                                                   POLL_INTERVAL)
+                    if not readable:
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notification = dbapi_connection.notifies.pop(0)
+                        self.deliver(json.loads(notification.payload))
+            except Exception:
+                logger.exception('Change feed connection lost')
+                self._stopping.wait(RECONNECT_DELAY)
+            finally:
+                connection.close()
+
+
+'''
+attach(feed) / detach()
+    make feed the change feed of this process: local writes are published to
+    it and the events of other processes received from it are applied
+'''
+
+active_feed = None
+_revisions = itertools.count(1)
+_revisions_lock = threading.Lock()
+_last_seen = {}
+_applying = threading.local()
+
+
+def attach(feed):
+    global active_feed
+    if feed is active_feed:
+        return
+    detach()
+    feed.subscribe(apply_changes)
+    active_feed = feed
+
+
+def detach():
+    global active_feed
+    feed, active_feed = active_feed, None
+    if feed is not None:
+        feed.stop()
+
+
+def reset_event():
+    ''' Returns an event resetting every cache, for subscribers that may have
+    missed events
+    '''
+    return {'origin': None, 'revision': None, 'table': None,
+            'action': 'reset', 'id': None, 'record': None, 'previous': None}
+
+
+@on_change
+def publish_change(table, action, record, previous):
+    feed = active_feed
+    if feed is None or getattr(_applying, 'active', False):
+        return
+
+    with _revisions_lock:
+        revision = next(_revisions)
+    feed.publish([{
+        'origin': ORIGIN,
+        'revision': revision,
+        'table': table,
+        'action': action,
+        'id': None if record is None else record.get('id'),
+        'record': record,
+        'previous': previous
+    }])
+
+
+def apply_changes(events):
+    ''' Applies the events of other processes to the caches of this one.
+
+    The revisions of each origin are consecutive. A gap means events were
+    lost, and every cache is reset.
+    '''
+    for event in events:
+        origin = event['origin']
+        if origin == ORIGIN:
+            continue
+
+        _applying.active = True
+        try:
+            if origin is not None:
+                last = _last_seen.get(origin)
+                _last_seen[origin] = event['revision']
+                if last is not None and event['revision'] != last + 1:
+                    notify_change(None, 'reset')
+
+            if event['action'] == 'reset':
+                notify_change(event['table'], 'reset')
+            elif event['record'] is None:
+                # Dropped from an oversized event, reload the whole table
+                notify_change(event['table'], 'reset')
+            else:
+                notify_change(event['table'], event['action'],
+                              event['record'], event['previous'])
+        finally:
+            _applying.active = False
+
+
+def feed_from_environment(database_uri=None, environ=os.environ):
+    ''' Returns the change feed named by TRIVIA_CHANGE_FEED, or None.
+
+    "postgres" selects a PostgresChangeFeed on the TRIVIA_CHANGE_CHANNEL
+    channel, "local" an in-process ChangeFeed and "none" no feed. Unset, it
+    defaults to "postgres" when database_uri is a PostgreSQL database, so
+    the workers sharing it keep their caches current.
+    '''
+    name = environ.get('TRIVIA_CHANGE_FEED', '').lower()
+    if not name and database_uri is not None and \
+            make_url(database_uri).get_backend_name() == 'postgresql':
+        name = 'postgres'
+    if name in ('postgres', 'postgresql'):
+        return PostgresChangeFeed(
+            environ.get('TRIVIA_CHANGE_CHANNEL', DEFAULT_CHANNEL))
+    if name == 'local':
+        return ChangeFeed()
+    return None
@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+'''
+engine_config
+    database engine tuning: pool sizing, connection lifetime, statement
+    timeouts, executemany batching and read replicas, read from a mapping
+    (the app config) with TRIVIA_-prefixed environment variables as fallback
+'''
+
+ENV_PREFIX = 'TRIVIA_'
+
+ENGINE_CONFIG_DEFAULTS = {
+    # Connections kept open per worker process
+    'DB_POOL_SIZE': 5,
+    # Extra connections opened past DB_POOL_SIZE under load
+    'DB_MAX_OVERFLOW': 10,
+    # Seconds to wait for a pooled connection before failing
+    'DB_POOL_TIMEOUT': 30,
+    # Seconds after which a connection is replaced, -1 to keep it forever
+    'DB_POOL_RECYCLE': 1800,
+    # Test connections with a round trip before handing them out
+    'DB_POOL_PRE_PING': True,
+    # Milliseconds a statement may run before PostgreSQL cancels it, 0 for no limit
+    'DB_STATEMENT_TIMEOUT': 0,
+    # psycopg2 executemany strategy: values, batch or default (one per row)
+    'DB_EXECUTEMANY_MODE': 'values',
+    'DB_EXECUTEMANY_PAGE_SIZE': 1000,
+    # Comma separated URLs of read replicas of the database, see read_replicas
+    'DB_REPLICAS': '',
+    # Seconds between health checks of each replica
+    'DB_REPLICA_CHECK_INTERVAL': 5,
+    # Seconds replicas may lag behind, reads stay on the primary that long
+    # after a change
+    'DB_REPLICA_LAG': 5,
+}
+
+# Upper bounds, in seconds, of the checkout wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def _parse(value, default):
+    if not isinstance(value, str):
+        return value
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(value)
+    return value
+
+
+def load_engine_config(mapping=None, environ=os.environ):
+    ''' Returns the engine settings from mapping, the environment or defaults.
+
+    A key set in mapping wins over the TRIVIA_<key> environment variable.
+    String values are converted to the type of the default.
+    '''
+    mapping = mapping or {}
+    config = {}
+    for key, default in ENGINE_CONFIG_DEFAULTS.items():
+        if key in mapping:
+            value = mapping[key]
+        else:
+            value = environ.get(ENV_PREFIX + key, default)
+        config[key] = _parse(value, default)
+    return config
+
+
+def engine_options(database_uri, config):
+    ''' Returns SQLALCHEMY_ENGINE_OPTIONS for database_uri from engine settings '''
+    url = make_url(database_uri)
+    if url.get_backend_name() == 'sqlite':
+        # SQLite connections are not pooled by size
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+
+    if url.get_backend_name() == 'postgresql':
+        if config['DB_STATEMENT_TIMEOUT']:
+            options['connect_args'] = {
+                'options':
+                f'-c statement_timeout={config["DB_STATEMENT_TIMEOUT"]}'
+            }
+        if url.get_driver_name() in ('', 'psycopg2'):
+            mode = config['DB_EXECUTEMANY_MODE']
+            page_size = config['DB_EXECUTEMANY_PAGE_SIZE']
+            options['executemany_mode'] = None if mode == 'default' else mode
+            if mode == 'values':
+                options['executemany_values_page_size'] = page_size
+            elif mode == 'batch':
+                options['executemany_batch_page_size'] = page_size
+
+    return options
+
+
+class PoolStats:
+    ''' Running statistics of how long checkouts waited for a connection '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.buckets = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            for position, bound in enumerate(WAIT_BUCKETS):
+                if wait <= bound:
+                    break
+            else:
+                position = len(WAIT_BUCKETS)
+            self.buckets[position] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'total_wait': self.total_wait,
+                'mean_wait': (self.total_wait / self.checkouts
+                              if self.checkouts else 0.0),
+                'max_wait': self.max_wait,
+                'buckets': dict(
+                    zip([str(bound) for bound in WAIT_BUCKETS] + ['+Inf'],
+                        self.buckets)),
+            }
+
+
+class TimedQueuePool(QueuePool):
+    ''' QueuePool recording how long each checkout waited in PoolStats '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            self.stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - started)
+        return connection
+
+
+def pool_stats(engine):
+    ''' Returns the checkout wait statistics of engine's pool, if it keeps any '''
+    stats = getattr(engine.pool, 'stats', None)
+    return stats.snapshot() if stats is not None else None
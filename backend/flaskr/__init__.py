@@ -1,34 +1,241 @@
 import os
-from flask import Flask, request, abort, jsonify
+import random
+import base64
+import binascii
+import click
+from flask import Flask, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
-
-from models import setup_db, Question, Category
+from sqlalchemy import func
+
+from change_feed import attach, feed_from_environment
+from models import setup_db, init_db, categories_cache, db, Question
+from read_replicas import replica_reads, route_reads
+from .bulk import (MAX_DIFFICULTY, MIN_DIFFICULTY, export_questions,
+                   import_questions, read_records)
+from .compression import compress
+from .filters import QuestionFilter, filter_from_args, filter_from_body
+from .http_cache import conditional
+from .instrumentation import instrument, metrics
+from .quiz import (MAX_QUIZ_BATCH, QUIZ_SESSION_TTL, draw_questions,
+                   question_index, start_session)
+from .response_cache import LRUResponseCache, cached_page, page_cache
+from .search import search_questions
+from .snapshot import active_snapshot
+from .serialization import (QUESTION_FIELDS, FastJSONEncoder, format_rows,
+                            json_response, parse_fields, question_rows)
+from .store import TTLStore
 
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+MAX_BULK_DELETE = 1000
+ALL_QUESTIONS = QuestionFilter()
 
 
-def paginate(request, selection):
+def paginate(request, question_filter=ALL_QUESTIONS, fields=QUESTION_FIELDS):
+    '''Returns one page of the questions matching a filter along with their count.
+
+    Only the requested page is fetched (LIMIT/OFFSET), as plain tuples of the
+    columns of fields, and formatted, the total comes from a separate COUNT
+    query. When reads are served from the question snapshot, both are taken
+    from it instead.
+    '''
     page = request.args.get('page', 1, type=int)
     start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
 
-    all_questions = [question.format() for question in selection]
-    current_questions = all_questions[start:end]
+    snapshot = active_snapshot()
+    if snapshot is not None:
+        total_questions, rows = snapshot.page(question_filter, start,
+                                              QUESTIONS_PER_PAGE, fields)
+    else:
+        selection = question_filter.apply(Question.query).order_by(
+            Question.id)
+        total_questions = selection.order_by(None).with_entities(
+            func.count(Question.id)).scalar()
+        if start < 0 or start >= total_questions:
+            rows = []
+        else:
+            rows = question_rows(selection, fields).offset(start).limit(
+                QUESTIONS_PER_PAGE).all()
 
     return {
         'current_page': page,
-        'total_questions': len(all_questions),
-        'current_questions': current_questions
+        'total_questions': total_questions,
+        'current_questions': format_rows(rows, fields)
+    }
+
+
+def write_response(request, **fields):
+    '''Returns the JSON body of a write response reporting fields.
+
+    By default only the new question total is added, using a COUNT query. The
+    current page of questions is fetched as well when the request passes a
+    truthy include_page query parameter.
+    '''
+    include_page = request.args.get('include_page', '').lower()
+
+    if include_page in ('1', 'true', 'yes'):
+        current_questions = paginate(request)
+        fields.update({
+            'questions': current_questions['current_questions'],
+            'total_questions': current_questions['total_questions'],
+            'current_page': current_questions['current_page']
+        })
+    else:
+        fields['total_questions'] = Question.query.count()
+
+    return json_response({'success': True, **fields})
+
+
+def encode_cursor(question_id):
+    '''Returns an opaque, URL safe cursor pointing after the given question id'''
+    encoded = base64.urlsafe_b64encode(str(question_id).encode('ascii'))
+    return encoded.decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''Returns the question id encoded by encode_cursor().
+
+    Raises:
+        ValueError if the cursor was not produced by encode_cursor().
+    '''
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        return int(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (binascii.Error, UnicodeEncodeError):
+        raise ValueError(f'Invalid cursor: {cursor}')
+
+
+def wants_cursor(request):
+    '''Returns True if the request opted in to keyset pagination'''
+    return 'after' in request.args or 'limit' in request.args
+
+
+def get_cursor(request):
+    '''Returns the question id from the request's after cursor or None.
+
+    Aborts with an HTTP 400 if the cursor cannot be decoded.
+    '''
+    cursor = request.args.get('after')
+    if not cursor:
+        return None
+
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+
+def get_filter(request, category_id=None):
+    '''Returns the QuestionFilter of the request's listing filters.
+
+    Aborts with an HTTP 400 if a filter parameter is malformed.
+    '''
+    try:
+        return filter_from_args(request.args, category_id)
+    except ValueError:
+        abort(400)
+
+
+def get_fields(request):
+    '''Returns the question fields selected by the fields query parameter.
+
+    Aborts with an HTTP 400 if it names an unknown field.
+    '''
+    try:
+        return parse_fields(request.args.get('fields'))
+    except ValueError:
+        abort(400)
+
+
+def get_question_ids(request):
+    '''Returns the question ids of a comma separated ids query parameter.
+
+    Aborts with an HTTP 400 if the list is missing, malformed or longer than
+    MAX_BULK_DELETE.
+    '''
+    try:
+        question_ids = [int(value)
+                        for value in request.args['ids'].split(',')]
+    except (KeyError, ValueError):
+        abort(400)
+
+    if len(question_ids) > MAX_BULK_DELETE:
+        abort(400)
+    return question_ids
+
+
+def paginate_after(request, after, question_filter=ALL_QUESTIONS,
+                   fields=QUESTION_FIELDS):
+    '''Returns the page of the questions matching a filter following a keyset
+    cursor.
+
+    Seeks on the questions primary key instead of using OFFSET, so every page
+    costs the same regardless of how deep into the results it is. Like
+    paginate(), reads the question snapshot instead when it is active.
+    '''
+    limit = request.args.get('limit', QUESTIONS_PER_PAGE, type=int)
+    limit = max(1, min(limit, MAX_QUESTIONS_PER_PAGE))
+
+    snapshot = active_snapshot()
+    if snapshot is not None:
+        questions = snapshot.page_after(question_filter, after, limit + 1,
+                                        fields)
+    else:
+        selection = question_filter.apply(Question.query)
+        if after is not None:
+            selection = selection.filter(Question.id > after)
+        questions = question_rows(selection, fields).order_by(
+            Question.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(questions) > limit:
+        questions = questions[:limit]
+        next_cursor = encode_cursor(questions[-1][0])
+
+    return {
+        'limit': limit,
+        'next_cursor': next_cursor,
+        'current_questions': format_rows(questions, fields)
     }
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.json_encoder = FastJSONEncoder
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    app.config.setdefault(
+        'QUESTION_SNAPSHOT',
+        os.environ.get('TRIVIA_QUESTION_SNAPSHOT', '').lower() in ('1', 'true',
+                                                                   'yes'))
+    app.config.setdefault('QUIZ_SESSION_STORE',
+                          TTLStore(ttl=QUIZ_SESSION_TTL))
+    page_cache.backend = app.config.setdefault('RESPONSE_CACHE',
+                                               LRUResponseCache())
     CORS(app, resources={r'/api/v1/*': {'origins': '*'}})
     setup_db(app)
+    change_feed = app.config.setdefault(
+        'CHANGE_FEED',
+        feed_from_environment(app.config['SQLALCHEMY_DATABASE_URI']))
+    if change_feed is not None:
+        attach(change_feed)
+        # Started with the first request, in the worker process
+        app.before_first_request(lambda: change_feed.start(app))
+    route_reads(app)
+    instrument(app)
+    # Registered after instrument(), so compression counts towards its timings
+    compress(app)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        '''Creates the database schema or upgrades it to the latest version'''
+        applied = init_db(app)
+        if applied:
+            click.echo('Applied migrations ' +
+                       ', '.join(str(version) for version in applied))
+        else:
+            click.echo('Schema is up to date')
 
     @app.after_request
     def after_request(response):
@@ -78,11 +285,26 @@ def create_app(test_config=None):
 
     # ROUTES
 
+    @app.route('/metrics')
+    def get_metrics():
+        ''' Handles requests for the request metrics of this process.
+
+        Returns:
+            Per-route histograms of request, database and serialization time and
+            of statements per request, plus connection pool wait times, in the
+            Prometheus text format.
+        '''
+        return app.response_class(metrics.render(db.engine),
+                                  mimetype='text/plain; version=0.0.4')
+
     @app.route('/api/v1/categories')
+    @replica_reads
+    @conditional
     def get_categories():
         ''' Handles requests for categories.
 
-        Accepts get requests for categories and retrieves all categories from the database.
+        Accepts get requests for categories and retrieves all categories from the
+        in-memory categories cache.
 
         Returns:
             A JSON response reporting success and all categories as JSON objects or an HTTP
@@ -92,54 +314,78 @@ def create_app(test_config=None):
             An HTTP 422 is returned if the request cannot be successfully processed.
         '''
         try:
-            categories = Category.query.order_by(Category.id).all()
+            categories = categories_cache.get()
+            categories_json = categories_cache.get_json()
         except:
             abort(422)
 
         if not categories:
             abort(404)
 
-        formatted_categories = {
-            category.id: category.type
-            for category in categories
-        }
-
-        return jsonify({'success': True, 'categories': formatted_categories})
+        return app.response_class(
+            b'{"success": true, "categories": ' + categories_json + b'}\n',
+            mimetype='application/json')
 
     @app.route('/api/v1/questions')
+    @replica_reads
+    @conditional
+    @cached_page(QUESTIONS_PER_PAGE)
     def get_questions():
         ''' Handles requests for questions.
 
         Accepts get requests for questions and retrieves all questions from the database.
 
+        Passing after and/or limit query parameters switches to keyset pagination.
+        A comma separated categories list and min_difficulty and max_difficulty
+        parameters filter the questions, and a comma separated fields list limits
+        the question fields returned, and read, to those named plus id.
+
         Returns:
             A JSON response reporting success, a list of formatted questions, total questions
             the current page of results and all categories as JSON objects. If the are no
-            questions retrieved from the database, an HTTP 404 is returned.
+            questions retrieved from the database, an HTTP 404 is returned. In keyset mode
+            the total and current page are replaced by the page limit and next_cursor.
 
         Raises:
-            An HTTP 422 is returned if the request cannot be successfully processed.
+            An HTTP 400 is returned for malformed filters, fields or cursors and
+            an HTTP 422 if the request cannot be successfully processed.
         '''
+        question_filter = get_filter(request)
+        fields = get_fields(request)
+        if wants_cursor(request):
+            after = get_cursor(request)
+            try:
+                current_questions = paginate_after(request, after,
+                                                   question_filter, fields)
+                categories = categories_cache.get()
+            except:
+                abort(422)
+
+            if after is None and not current_questions['current_questions']:
+                abort(404)
+
+            return json_response({
+                'success': True,
+                'questions': current_questions['current_questions'],
+                'categories': categories,
+                'current_category': None,
+                'limit': current_questions['limit'],
+                'next_cursor': current_questions['next_cursor']
+            })
+
         try:
-            all_questions = Question.query.order_by(Question.id).all()
-            categories = Category.query.order_by(Category.id).all()
+            current_questions = paginate(request, question_filter, fields)
+            categories = categories_cache.get()
         except:
             abort(422)
 
-        current_questions = paginate(request, all_questions)
-
         if len(current_questions['current_questions']) == 0:
             abort(404)
 
-        formatted_categories = {
-            category.id: category.type
-            for category in categories
-        }
-
-        return jsonify({
+        return json_response({
             'success': True,
             'questions': current_questions['current_questions'],
-            'categories': formatted_categories,
+            'categories': categories,
             'current_category': None,
             'total_questions': current_questions['total_questions'],
             'current_page': current_questions['current_page']
@@ -154,9 +400,10 @@ def create_app(test_config=None):
 
         Returns:
             A JSON response reporting success, the question id for the deleted
-            question, a list of formatted questions, total questions the current
-            page of results and all categories as JSON objects. If the does not
-            exist in the database, an HTTP 404 is returned.
+            question and total questions as JSON objects. With include_page=true
+            the list of formatted questions and the current page of results are
+            included as well. If the does not exist in the database, an HTTP 404
+            is returned.
 
         Raises:
             An HTTP 422 is returned if the request cannot be successfully processed.
@@ -171,16 +418,42 @@ def create_app(test_config=None):
 
         try:
             question.delete()
-            all_questions = Question.query.order_by(Question.id).all()
-            current_questions = paginate(request, all_questions)
 
-            return jsonify({
-                'success': True,
-                'deleted': question_id,
-                'questions': current_questions['current_questions'],
-                'total_questions': current_questions['total_questions'],
-                'current_page': current_questions['current_page']
-            })
+            return write_response(request, deleted=question_id)
+        except:
+            abort(422)
+
+    @app.route('/api/v1/questions', methods=['DELETE'])
+    def delete_questions():
+        ''' Handles bulk delete requests for questions.
+
+        Accepts a comma separated list of question ids in the ids query parameter
+        and deletes those questions in a single transaction, with one SELECT and
+        one DELETE statement.
+
+        Returns:
+            A JSON response reporting success, the sorted ids of the deleted
+            questions and total questions as JSON objects. With include_page=true
+            the list of formatted questions and the current page of results are
+            included as well. Ids of questions that do not exist are skipped, if
+            none of them exist an HTTP 404 is returned.
+
+        Raises:
+            An HTTP 400 is returned if ids is missing, malformed or lists more than
+            MAX_BULK_DELETE ids, an HTTP 422 if the questions cannot be deleted.
+        '''
+        question_ids = get_question_ids(request)
+
+        try:
+            deleted = Question.delete_many(question_ids)
+        except:
+            abort(422)
+
+        if not deleted:
+            abort(404)
+
+        try:
+            return write_response(request, deleted=deleted)
         except:
             abort(422)
 
@@ -189,30 +462,39 @@ def create_app(test_config=None):
         ''' Handles post requests for question.
 
         Accepts post requests for new questions that a users submits to the
-        database.
+        database. A request carrying a searchTerm runs a ranked full-text search
+        over the question text instead, the fields query parameter limits the
+        question fields of its results as for listings.
 
         Returns:
             A JSON response reporting success, a list of formatted questions, total
-            questions and the current page of results as JSON objects.
+            questions and the current page of results as JSON objects. A new question
+            is reported by its id and total questions, plus the list of formatted
+            questions and current page of results with include_page=true.
 
         Raises:
-            An HTTP 422 is returned if the new question is unable to be added to the DB
+            An HTTP 400 is returned for unknown search result fields and an HTTP
+            422 if the new question is unable to be added to the DB
         '''
         if request.get_json().get('searchTerm'):
             search_term = request.get_json().get('searchTerm')
-            search_questions = Question.query.filter(
-                Question.question.ilike(f'%{search_term}%')).all()
+            page = request.args.get('page', 1, type=int)
+            fields = get_fields(request)
+            try:
+                total_questions, questions = search_questions(
+                    search_term, page, QUESTIONS_PER_PAGE, active_snapshot(),
+                    fields)
+            except:
+                abort(422)
 
-            if not search_questions:
+            if not total_questions:
                 abort(404)
             else:
-                search_results = paginate(request, search_questions)
-
-                return jsonify({
+                return json_response({
                     'success': True,
-                    'questions': search_results['current_questions'],
-                    'total_questions': search_results['total_questions'],
-                    'current_page': search_results['current_page']
+                    'questions': questions,
+                    'total_questions': total_questions,
+                    'current_page': page
                 })
         else:
             request_body = request.get_json()
@@ -220,6 +502,8 @@ def create_app(test_config=None):
             new_answer = request_body.get('answer', None)
             new_category = int(request_body.get('category', None))
             new_difficulty = int(request_body.get('difficulty', None))
+            if not MIN_DIFFICULTY <= new_difficulty <= MAX_DIFFICULTY:
+                abort(422)
 
             try:
                 new_question = Question(question=new_question,
@@ -228,19 +512,55 @@ def create_app(test_config=None):
                                         difficulty=new_difficulty)
                 new_question.insert()
 
-                all_questions = Question.query.order_by(Question.id).all()
-                current_questions = paginate(request, all_questions)
-
-                return jsonify({
-                    'success': True,
-                    'questions': current_questions['current_questions'],
-                    'total_questions': current_questions['total_questions'],
-                    'current_page': current_questions['current_page']
-                })
+                return write_response(request, created=new_question.id)
             except:
                 abort(422)
 
+    @app.route('/api/v1/questions/bulk', methods=['POST'])
+    def bulk_import_questions():
+        ''' Handles bulk imports of questions.
+
+        Accepts a newline delimited JSON, or CSV (Content-Type: text/csv), request
+        body with one question per line. The body is read as a stream and valid
+        questions are inserted in batches with multi-row INSERT statements.
+
+        Returns:
+            A JSON response reporting success, the number of inserted and rejected
+            questions and, for the rejected ones, their line number and the reason.
+
+        Raises:
+            An HTTP 422 is returned if the body cannot be read or a batch cannot be
+            inserted. Batches inserted before the failure are kept.
+        '''
+        try:
+            inserted, failed, errors = import_questions(
+                read_records(request), categories_cache.get())
+        except:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'inserted': inserted,
+            'failed': failed,
+            'errors': errors
+        })
+
+    @app.route('/api/v1/questions/export')
+    @replica_reads
+    def bulk_export_questions():
+        ''' Handles exports of the whole question bank.
+
+        Returns:
+            A streamed newline delimited JSON response with one question per line.
+        '''
+        return app.response_class(stream_with_context(export_questions()),
+                                  mimetype='application/x-ndjson')
+
     @app.route('/api/v1/categories/<int:category_id>/questions')
+    @replica_reads
+    @conditional
+    @cached_page(QUESTIONS_PER_PAGE)
     def get_question_by_category(category_id):
         ''' Handles get requests for questions by category.
 
@@ -251,85 +571,144 @@ def create_app(test_config=None):
             questions, all categories, the user selected current category and the
             current page of results as JSON objects. If the category does not exist
             in the DB or there are no questions for a valid category selection, an
-            HTTP 404 is returned.
+            HTTP 404 is returned. Passing after and/or limit query parameters returns
+            the page limit and next_cursor instead of the total and current page.
+            min_difficulty and max_difficulty parameters filter the questions and
+            a fields list limits the question fields as for all questions.
 
         Raises:
-            An HTTP 422 is returned if the request cannot be successfully processed.
+            An HTTP 400 is returned for malformed filters, fields or cursors and
+            an HTTP 422 if the request cannot be successfully processed.
         '''
-        selected_category = Category.query.filter_by(
-            id=category_id).one_or_none()
+        question_filter = get_filter(request, category_id)
+        fields = get_fields(request)
+        categories = categories_cache.get()
+        current_category = categories.get(category_id)
 
-        if selected_category is None:
+        if current_category is None:
             abort(404)
 
-        questions = Question.query.filter_by(
-            category=selected_category.id).order_by(Question.id).all()
+        if wants_cursor(request):
+            after = get_cursor(request)
+            current_questions = paginate_after(request, after,
+                                               question_filter, fields)
 
-        if not questions:
-            abort(404)
+            if after is None and not current_questions['current_questions']:
+                abort(404)
 
-        try:
-            current_questions = paginate(request, questions)
-            all_categories = Category.query.order_by(Category.id).all()
-            formatted_categories = {
-                category.id: category.type
-                for category in all_categories
+            page_fields = {
+                'limit': current_questions['limit'],
+                'next_cursor': current_questions['next_cursor']
             }
+        else:
+            current_questions = paginate(request, question_filter, fields)
 
-            return jsonify({
-                'success': True,
-                'questions': current_questions['current_questions'],
-                'categories': formatted_categories,
-                'current_category': selected_category.type,
+            if not current_questions['total_questions']:
+                abort(404)
+
+            page_fields = {
                 'total_questions': current_questions['total_questions'],
                 'current_page': current_questions['current_page']
+            }
+
+        try:
+            return json_response({
+                'success': True,
+                'questions': current_questions['current_questions'],
+                'categories': categories,
+                'current_category': current_category,
+                **page_fields
             })
         except:
             abort(422)
 
     @app.route('/api/v1/quizzes', methods=['POST'])
+    @replica_reads
     def start_quiz():
         ''' Handles post requests for quiz answer submissions.
 
         Accepts post requests for questions by a user selected category. The
         question is randomly selected and returned to the user for answer.
 
+        Sending a categories list of ids instead of quiz_category draws from
+        all of them, and min_difficulty and max_difficulty bound the difficulty.
+        Sending count: N returns N distinct questions at once, and sending a
+        seed makes the random selection repeatable.
+
+        Sending session: true starts a server side quiz session whose quiz_id is
+        returned. Later requests only need to send that quiz_id instead of the
+        category and the growing list of previous questions.
+
         Returns:
-            A JSON response reporting success, a randomly selected question and the
-            remaining number of questions for the category selection as JSON objects.
-            If there are no questions, an HTTP 404 is returned.
+            A JSON response reporting success, a randomly selected question, or a
+            list of up to count questions, and the remaining number of questions
+            for the category selection as JSON objects, plus the quiz_id in
+            session mode. If there are no questions left or the quiz session has
+            expired, an HTTP 404 is returned.
 
         Raises:
             An HTTP 422 is returned if the request cannot be successfully processed.
         '''
         request_body = request.get_json()
 
-        selected_category = request_body.get('quiz_category')
         previous_questions = request_body.get('previous_questions')
+        quiz_sessions = app.config['QUIZ_SESSION_STORE']
+        quiz_id = request_body.get('quiz_id')
+        index = active_snapshot()
+        if index is None:
+            index = question_index
 
         try:
-            if selected_category['id'] == 0:
-                questions = Question.query.filter(
-                    Question.id.notin_(previous_questions)).order_by(
-                        Question.id).all()
-            else:
-                questions = Question.query.filter(
-                    Question.category == selected_category['id'],
-                    Question.id.notin_(previous_questions)).order_by(
-                        Question.id).all()
+            count = int(request_body.get('count', 1))
+            seed = request_body.get('seed')
+            rng = random if seed is None else random.Random(int(seed))
         except:
             abort(422)
 
-        if not questions:
-            abort(404)
+        if not 1 <= count <= MAX_QUIZ_BATCH:
+            abort(422)
 
-        available_questions = [question.format() for question in questions]
-        random_question = random.choice(available_questions)
+        if quiz_id is None and request_body.get('session'):
+            try:
+                quiz_id, _ = start_session(quiz_sessions,
+                                           filter_from_body(request_body),
+                                           previous_questions, rng=rng,
+                                           index=index)
+            except:
+                abort(422)
 
-        return jsonify({
-            'success': True,
-            'question': random_question,
-            'remaining_questions': len(available_questions) - 1
-        })
+        if quiz_id is not None:
+            session = quiz_sessions.get(quiz_id)
+            if session is None:
+                abort(404)
+
+            questions = session.next_questions(count, index)
+            if not questions:
+                quiz_sessions.pop(quiz_id)
+                abort(404)
+            # Shared stores hand out copies, the drawn questions are only
+            # recorded once the session is stored again
+            quiz_sessions.set(quiz_id, session)
+            remaining_questions = session.remaining
+        else:
+            try:
+                questions, remaining_questions = draw_questions(
+                    filter_from_body(request_body), previous_questions, count,
+                    rng=rng, index=index)
+            except:
+                abort(422)
+
+            if not questions:
+                abort(404)
+
+        response = {'success': True}
+        if quiz_id is not None:
+            response['quiz_id'] = quiz_id
+        if 'count' in request_body:
+            response['questions'] = questions
+        else:
+            response['question'] = questions[0]
+        response['remaining_questions'] = remaining_questions
+        return jsonify(response)
 
     return app
@@ -0,0 +1,168 @@
+import asyncio
+import io
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from engine_config import load_engine_config
+
+from . import create_app
+
+# Request bodies larger than this are spooled to a temporary file
+MAX_BODY_IN_MEMORY = 1024 * 1024
+
+
+def build_environ(scope, body):
+    ''' Returns the WSGI environ for an ASGI HTTP scope and its request body,
+    a seekable file holding the whole body.
+    '''
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    # The ASGI path includes the root path the app is mounted at
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        if key in environ:
+            # Cookie pairs are separated by semicolons, other headers by commas
+            separator = '; ' if key == 'HTTP_COOKIE' else ','
+            value = f'{environ[key]}{separator}{value}'
+        environ[key] = value
+
+    # Chunked HTTP/1.1 and HTTP/2 requests come without a Content-Length, the
+    # body has been read whole by now so its size is known either way
+    size = body.seek(0, io.SEEK_END)
+    body.seek(0)
+    environ['CONTENT_LENGTH'] = str(size)
+    return environ
+
+
+class AsgiApp:
+    ''' Serves the trivia Flask app, and so the same /api/v1 routes, over ASGI.
+
+    This is a WSGI to ASGI bridge, not an asynchronous app: the pinned
+    SQLAlchemy 1.3 has no asyncio support, so the views, and with them all
+    database work, run unchanged on a thread pool sized to the engine's
+    connection pool. Concurrent database work is capped as under a WSGI
+    server. Request bodies are read on the event loop before a worker thread
+    is taken, so slow uploads do not hold one.
+    '''
+
+    def __init__(self, app, max_workers=None):
+        self.app = app
+        if max_workers is None:
+            config = load_engine_config(app.config)
+            max_workers = config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW']
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='trivia-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f'Unsupported ASGI scope type {scope["type"]}')
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive):
+        body = tempfile.SpooledTemporaryFile(max_size=MAX_BODY_IN_MEMORY)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                body.seek(0)
+                return body
+
+    def _respond(self, environ, send):
+        # The whole request runs on one worker thread, so the scoped database
+        # session of a streamed response is the one its view started with
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'),
+                                   value.encode('latin-1'))
+                                  for name, value in headers]
+
+        iterable = self.app(environ, start_response)
+        try:
+            send({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': started['headers']
+            })
+            for chunk in iterable:
+                if chunk:
+                    send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True
+                    })
+            send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    async def _http(self, scope, receive, send):
+        body = await self._read_body(receive)
+        if body is None:
+            return
+
+        loop = asyncio.get_running_loop()
+
+        def send_from_worker(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        try:
+            await loop.run_in_executor(self.executor, self._respond,
+                                       build_environ(scope, body),
+                                       send_from_worker)
+        finally:
+            body.close()
+
+
+def create_asgi_app(test_config=None):
+    ''' Returns the ASGI flavour of create_app(test_config).
+
+    Run it under any ASGI server, e.g.
+    uvicorn --factory flaskr.asgi:create_asgi_app
+    '''
+    return AsgiApp(create_app(test_config))
@@ -0,0 +1,123 @@
+import csv
+import json
+
+from models import bump_stored_revision, db, notify_change, Question
+from .serialization import QUESTION_COLUMNS, dumps, format_row
+
+BULK_BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 100
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+
+
+def validate_question(record, categories):
+    ''' Returns the column values for a new question described by record.
+
+    Raises:
+        ValueError describing the first problem found with record.
+    '''
+    if not isinstance(record, dict):
+        raise ValueError('expected an object')
+
+    values = {}
+    for field in ('question', 'answer'):
+        value = record.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f'{field} must be a non-empty string')
+        values[field] = value
+
+    for field in ('category', 'difficulty'):
+        try:
+            values[field] = int(record.get(field))
+        except (TypeError, ValueError):
+            raise ValueError(f'{field} must be an integer')
+
+    if values['category'] not in categories:
+        raise ValueError(f'category {values["category"]} does not exist')
+    if not MIN_DIFFICULTY <= values['difficulty'] <= MAX_DIFFICULTY:
+        raise ValueError(f'difficulty must be between {MIN_DIFFICULTY} and '
+                         f'{MAX_DIFFICULTY}')
+
+    return values
+
+
+def read_records(request):
+    ''' Yields (line number, record) pairs streamed from the request body.
+
+    CSV bodies (text/csv) need a header row naming the question fields,
+    anything else is read as newline delimited JSON. Lines that cannot be
+    parsed are yielded with a ValueError in place of the record.
+    '''
+    lines = (line.decode('utf-8-sig') for line in request.stream)
+
+    if request.mimetype == 'text/csv':
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as error:
+            yield line_number, ValueError(f'invalid JSON: {error}')
+
+
+def import_questions(records, categories, batch_size=BULK_BATCH_SIZE):
+    ''' Inserts valid records with one multi-row INSERT and commit per batch.
+
+    Returns:
+        A tuple of the number of inserted questions, the number of rejected
+        records and the errors of the first MAX_REPORTED_ERRORS of those.
+    '''
+    inserted = 0
+    failed = 0
+    errors = []
+    batch = []
+
+    def flush():
+        nonlocal inserted
+        db.session.execute(Question.__table__.insert().values(batch))
+        bump_stored_revision()
+        db.session.commit()
+        inserted += len(batch)
+        batch.clear()
+
+    try:
+        for line_number, record in records:
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                batch.append(validate_question(record, categories))
+            except ValueError as error:
+                failed += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({'line': line_number, 'error': str(error)})
+                continue
+
+            if len(batch) >= batch_size:
+                flush()
+
+        if batch:
+            flush()
+    finally:
+        if inserted:
+            notify_change('questions', 'reset')
+
+    return inserted, failed, errors
+
+
+def export_questions(batch_size=BULK_BATCH_SIZE):
+    ''' Yields every question as a line of newline delimited JSON.
+
+    Rows are read as plain tuples through a server side cursor, batch_size at
+    a time, so memory use does not grow with the size of the bank.
+    '''
+    rows = db.session.query(*QUESTION_COLUMNS).order_by(
+        Question.id).execution_options(stream_results=True).yield_per(
+            batch_size)
+
+    for row in rows:
+        yield dumps(format_row(row)) + b'\n'
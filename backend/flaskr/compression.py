@@ -0,0 +1,102 @@
+import gzip
+
+from flask import request
+
+from .instrumentation import timed
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+# Content codings offered, in order of preference when the client weighs
+# them equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain')
+
+# Smaller bodies are sent as they are, compressing them gains little
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+DEFAULT_GZIP_LEVEL = 6
+# Brotli's default quality of 11 is meant for static assets, 5 compresses
+# better than gzip at a similar speed
+DEFAULT_BROTLI_QUALITY = 5
+
+
+def negotiate(accept_encodings):
+    ''' Returns the preferred content coding of ENCODINGS the client accepts,
+    or None to send the body as it is.
+
+    An explicit quality for a coding wins over a * wildcard, and a quality of
+    0 refuses the coding.
+    '''
+    qualities = dict(accept_encodings)
+    wildcard = qualities.get('*', 0)
+    best = None
+    best_quality = 0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, wildcard)
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+
+def encoded_etag(etag, encoding):
+    ''' Returns the entity tag of the representation of etag in encoding '''
+    return f'{etag}-{encoding}'
+
+
+def etag_variants(etag):
+    ''' Returns the entity tags of every representation of etag '''
+    return (etag,) + tuple(encoded_etag(etag, encoding)
+                           for encoding in ENCODINGS)
+
+
+def encode(data, encoding, config):
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=config['COMPRESS_GZIP_LEVEL'])
+
+
+def compress(app):
+    ''' Compresses the JSON and text responses of app.
+
+    The coding is negotiated from Accept-Encoding: brotli when it is installed
+    and gzip otherwise. Bodies smaller than COMPRESS_MIN_SIZE bytes and
+    streamed responses, like exports, are sent as they are. A compressed
+    response gets its own entity tag, so caches never hand one encoding to a
+    client that asked for another. COMPRESS_RESPONSES turns it off.
+    '''
+    app.config.setdefault('COMPRESS_RESPONSES', True)
+    app.config.setdefault('COMPRESS_MIN_SIZE', DEFAULT_COMPRESS_MIN_SIZE)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', DEFAULT_GZIP_LEVEL)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', DEFAULT_BROTLI_QUALITY)
+
+    @app.after_request
+    def compress_response(response):
+        if not app.config['COMPRESS_RESPONSES'] or \
+                response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if response.is_streamed or response.direct_passthrough or \
+                response.status_code < 200 or response.status_code == 204 or \
+                'Content-Encoding' in response.headers:
+            return response
+
+        encoding = negotiate(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+
+        with timed('serialize'):
+            response.set_data(encode(data, encoding, app.config))
+        response.headers['Content-Encoding'] = encoding
+
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(encoded_etag(etag, encoding), weak)
+        return response
@@ -0,0 +1,108 @@
+from models import Question
+from .bulk import MAX_DIFFICULTY, MIN_DIFFICULTY
+
+
+class QuestionFilter:
+    ''' Selects the questions a quiz draws from or a listing shows.
+
+    categories is a set of category ids, or None for every question including
+    those without a category. min_difficulty and max_difficulty bound the
+    difficulty inclusively, None leaves that end open. Questions without a
+    difficulty only match a filter without difficulty bounds.
+    '''
+    __slots__ = ('categories', 'min_difficulty', 'max_difficulty')
+
+    def __init__(self, categories=None, min_difficulty=None,
+                 max_difficulty=None):
+        self.categories = (None if categories is None
+                           else frozenset(categories))
+        self.min_difficulty = min_difficulty
+        self.max_difficulty = max_difficulty
+
+    @classmethod
+    def for_category(cls, category_id):
+        ''' Returns the filter of a single category id, 0 meaning all '''
+        return cls(None if category_id == 0 else (category_id,))
+
+    @property
+    def bounds_difficulty(self):
+        return self.min_difficulty is not None or \
+            self.max_difficulty is not None
+
+    def includes(self, category_id, difficulty):
+        ''' Returns True if questions of category_id and difficulty match '''
+        if self.categories is not None and category_id not in self.categories:
+            return False
+        if difficulty is None:
+            return not self.bounds_difficulty
+        if self.min_difficulty is not None and difficulty < self.min_difficulty:
+            return False
+        if self.max_difficulty is not None and difficulty > self.max_difficulty:
+            return False
+        return True
+
+    def apply(self, query):
+        ''' Returns query restricted to the matching questions '''
+        if self.categories is not None:
+            query = query.filter(
+                Question.category.in_(sorted(self.categories)))
+        if self.min_difficulty is not None:
+            query = query.filter(Question.difficulty >= self.min_difficulty)
+        if self.max_difficulty is not None:
+            query = query.filter(Question.difficulty <= self.max_difficulty)
+        return query
+
+
+def _difficulty(value):
+    if value is None or value == '':
+        return None
+    difficulty = int(value)
+    if not MIN_DIFFICULTY <= difficulty <= MAX_DIFFICULTY:
+        raise ValueError(f'Difficulty out of range: {difficulty}')
+    return difficulty
+
+
+def _filter(categories, min_difficulty, max_difficulty):
+    min_difficulty = _difficulty(min_difficulty)
+    max_difficulty = _difficulty(max_difficulty)
+    if None not in (min_difficulty, max_difficulty) and \
+            min_difficulty > max_difficulty:
+        raise ValueError('min_difficulty is above max_difficulty')
+    return QuestionFilter(categories, min_difficulty, max_difficulty)
+
+
+def filter_from_args(args, category_id=None):
+    ''' Returns the QuestionFilter of listing query parameters.
+
+    Reads a comma separated categories list, unless category_id fixes the
+    category, and min_difficulty and max_difficulty.
+
+    Raises:
+        ValueError if a parameter is malformed or out of range.
+    '''
+    if category_id is not None:
+        categories = (category_id,)
+    elif args.get('categories'):
+        categories = [int(value) for value in args['categories'].split(',')]
+    else:
+        categories = None
+    return _filter(categories, args.get('min_difficulty'),
+                   args.get('max_difficulty'))
+
+
+def filter_from_body(body):
+    ''' Returns the QuestionFilter of a quiz request body.
+
+    A categories list of ids wins over quiz_category, whose id 0 means all
+    categories. min_difficulty and max_difficulty bound the difficulty.
+
+    Raises:
+        ValueError, TypeError or KeyError if the body is malformed.
+    '''
+    if body.get('categories') is not None:
+        categories = [int(category_id) for category_id in body['categories']]
+    else:
+        category_id = int(body['quiz_category']['id'])
+        categories = None if category_id == 0 else (category_id,)
+    return _filter(categories, body.get('min_difficulty'),
+                   body.get('max_difficulty'))
@@ -0,0 +1,44 @@
+from functools import wraps
+
+from flask import current_app, request
+
+from models import bank_revision
+from .compression import etag_variants
+
+DEFAULT_CACHE_CONTROL = 'public, no-cache'
+
+
+def conditional(view):
+    ''' Makes a read-only view answer conditional GETs from the bank revision.
+
+    Successful responses carry a strong ETag for the current bank revision and
+    a Cache-Control header (HTTP_CACHE_CONTROL setting). A request whose
+    If-None-Match still matches gets a 304 without the view, or the database,
+    being touched. The tags of compressed representations, see compression,
+    match as well.
+    '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Read before the view runs, so a write racing it can only make the
+        # tag older than the body and never the other way around
+        etag = bank_revision.etag()
+        cache_control = current_app.config.get('HTTP_CACHE_CONTROL',
+                                               DEFAULT_CACHE_CONTROL)
+
+        matched = next((candidate for candidate in etag_variants(etag)
+                        if request.if_none_match.contains_weak(candidate)),
+                       None)
+        if matched is not None:
+            response = current_app.response_class(status=304)
+            response.vary.add('Accept-Encoding')
+            etag = matched
+        else:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    return wrapper
@@ -0,0 +1,253 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from engine_config import WAIT_BUCKETS, pool_stats
+
+# Upper bounds, in seconds, of the request, database and serialization
+# duration histogram buckets
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Statements slower than this many milliseconds are logged
+DEFAULT_SLOW_QUERY_MS = 100
+# A statement run this many times by one request is logged as a likely N+1
+DEFAULT_N_PLUS_ONE_THRESHOLD = 10
+
+
+class Histogram:
+    ''' Prometheus style histogram with one series per label set '''
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [
+                    [0] * (len(self.buckets) + 1), 0.0
+                ]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                position = len(self.buckets)
+            series[0][position] += 1
+            series[1] += value
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted(self._series.items())
+            series = [(key, list(counts), total)
+                      for key, (counts, total) in series]
+
+        for key, counts, total in series:
+            labels = ','.join(f'{name}="{value}"' for name, value in key)
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} '
+                             f'{cumulative}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    ''' Per-route request metrics of this process '''
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            'trivia_request_duration_seconds',
+            'Time spent handling a request', DURATION_BUCKETS)
+        self.db_duration = Histogram(
+            'trivia_request_db_seconds',
+            'Time a request spent executing SQL statements', DURATION_BUCKETS)
+        self.serialize_duration = Histogram(
+            'trivia_request_serialize_seconds',
+            'Time a request spent formatting and encoding its response',
+            DURATION_BUCKETS)
+        self.queries = Histogram(
+            'trivia_request_queries',
+            'SQL statements executed per request', QUERY_COUNT_BUCKETS)
+
+    @property
+    def histograms(self):
+        return (self.request_duration, self.db_duration,
+                self.serialize_duration, self.queries)
+
+    def observe(self, route, method, status, timings):
+        labels = {'route': route, 'method': method, 'status': str(status)}
+        self.request_duration.observe(timings['total'], **labels)
+        self.db_duration.observe(timings['db'], **labels)
+        self.serialize_duration.observe(timings['serialize'], **labels)
+        self.queries.observe(timings['queries'], **labels)
+
+    def clear(self):
+        for histogram in self.histograms:
+            histogram.clear()
+
+    def render(self, engine=None):
+        ''' Returns the metrics in the Prometheus text exposition format '''
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+
+        stats = pool_stats(engine) if engine is not None else None
+        if stats is not None:
+            lines.extend([
+                '# HELP trivia_db_pool_timeouts_total Connection checkouts '
+                'that timed out',
+                '# TYPE trivia_db_pool_timeouts_total counter',
+                f'trivia_db_pool_timeouts_total {stats["timeouts"]}',
+                '# HELP trivia_db_pool_wait_seconds Time connection checkouts '
+                'waited for the pool',
+                '# TYPE trivia_db_pool_wait_seconds histogram',
+            ])
+            cumulative = 0
+            for bound, count in zip(WAIT_BUCKETS + ('+Inf',),
+                                    stats['buckets'].values()):
+                cumulative += count
+                lines.append(
+                    f'trivia_db_pool_wait_seconds_bucket{{le="{bound}"}} '
+                    f'{cumulative}')
+            lines.append(f'trivia_db_pool_wait_seconds_sum '
+                         f'{stats["total_wait"]}')
+            lines.append(f'trivia_db_pool_wait_seconds_count '
+                         f'{stats["checkouts"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+def _request_timings():
+    ''' Returns the timings of the current request, or None outside one '''
+    if not has_request_context():
+        return None
+    return g.get('request_timings')
+
+
+@contextmanager
+def timed(phase):
+    ''' Adds the time spent in the block to phase of the current request '''
+    timings = _request_timings()
+    if timings is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] += time.perf_counter() - started
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context,
+                           executemany):
+    connection.info.setdefault('query_started', []).append(
+        time.perf_counter())
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context,
+                          executemany):
+    started = connection.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    timings = _request_timings()
+    if timings is None:
+        return
+
+    timings['db'] += elapsed
+    timings['queries'] += 1
+    g.request_statements[statement] += 1
+
+    slow_query_ms = current_app.config['SLOW_QUERY_MS']
+    if slow_query_ms and elapsed * 1000 >= slow_query_ms:
+        current_app.logger.warning('Slow query (%.1f ms) in %s %s: %s',
+                                   elapsed * 1000, request.method,
+                                   request.path, statement)
+
+
+_engine_events_lock = threading.Lock()
+_engine_events_listening = False
+
+
+def _listen_engine_events():
+    global _engine_events_listening
+    with _engine_events_lock:
+        if not _engine_events_listening:
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+            _engine_events_listening = True
+
+
+def instrument(app):
+    ''' Instruments every request of app.
+
+    Each response carries a Server-Timing header with the time spent in SQL,
+    the number of statements, the time spent formatting and encoding the
+    response and the total. The same numbers feed the per-route histograms of
+    metrics. Statements slower than SLOW_QUERY_MS, and statements a request
+    repeats N_PLUS_ONE_THRESHOLD times or more, are logged as warnings.
+    '''
+    app.config.setdefault('SERVER_TIMING', True)
+    app.config.setdefault('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS)
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', DEFAULT_N_PLUS_ONE_THRESHOLD)
+    _listen_engine_events()
+
+    @app.before_request
+    def start_request_timings():
+        g.request_started = time.perf_counter()
+        g.request_timings = {'db': 0.0, 'queries': 0, 'serialize': 0.0}
+        g.request_statements = Counter()
+
+    @app.after_request
+    def record_request_timings(response):
+        timings = g.get('request_timings')
+        if timings is None:
+            return response
+
+        timings['total'] = time.perf_counter() - g.request_started
+        metrics.observe(request.endpoint or 'unmatched', request.method,
+                        response.status_code, timings)
+
+        threshold = app.config['N_PLUS_ONE_THRESHOLD']
+        for statement, count in g.request_statements.items():
+            if threshold and count >= threshold:
+                app.logger.warning(
+                    'Statement run %d times in %s %s, likely N+1: %s', count,
+                    request.method, request.path, statement)
+
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = ', '.join([
+                f'db;dur={timings["db"] * 1000:.2f};'
+                f'desc="{timings["queries"]} queries"',
+                f'serialize;dur={timings["serialize"] * 1000:.2f}',
+                f'total;dur={timings["total"] * 1000:.2f}',
+            ])
+        return response
@@ -0,0 +1,301 @@
+import heapq
+import random
+import secrets
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate
+
+from models import db, on_change, Question
+from read_replicas import primary_reads, reading_from_replica
+from .serialization import format_row, question_rows
+
+# Below this share of eligible ids, rejection sampling gives way to a scan
+MIN_ELIGIBLE_SHARE = 0.25
+QUIZ_SESSION_TTL = 30 * 60
+# Most questions a single quiz request may ask for
+MAX_QUIZ_BATCH = 50
+
+
+def _contains(ids, question_id):
+    position = bisect_left(ids, question_id)
+    return position < len(ids) and ids[position] == question_id
+
+
+def bucket_order(bucket):
+    ''' Sort key of a (category, difficulty) bucket, missing values last.
+
+    Pools are sampled in this order, so the same seed draws the same question
+    however the buckets were filled.
+    '''
+    return tuple((value is None, value or 0) for value in bucket)
+
+
+def count_eligible(pools, exclude=()):
+    ''' Returns the number of ids in the disjoint sorted arrays pools not in
+    exclude.
+    '''
+    excluded = sum(1 for question_id in exclude
+                   if any(_contains(ids, question_id) for ids in pools))
+    return sum(len(ids) for ids in pools) - excluded
+
+
+def pick_eligible(pools, exclude=(), rng=random):
+    ''' Draws a random id from the disjoint sorted arrays pools not in exclude.
+
+    Draws a position over all pools, which picks a pool weighted by its size
+    and then an id in it uniformly, with rejection against exclude, which must
+    be a set. Only scans the pools once most of their ids are excluded.
+
+    Returns:
+        A tuple of the drawn id, or None if nothing is eligible, and the
+        number of eligible ids left after the draw.
+    '''
+    eligible = count_eligible(pools, exclude)
+    if eligible <= 0:
+        return None, 0
+
+    total = sum(len(ids) for ids in pools)
+    if eligible >= total * MIN_ELIGIBLE_SHARE:
+        ends = list(accumulate(len(ids) for ids in pools))
+        while True:
+            position = rng.randrange(total)
+            pool = bisect_right(ends, position)
+            ids = pools[pool]
+            question_id = ids[position - ends[pool] + len(ids)]
+            if question_id not in exclude:
+                break
+    else:
+        question_id = rng.choice([
+            candidate for ids in pools for candidate in ids
+            if candidate not in exclude
+        ])
+
+    return question_id, eligible - 1
+
+
+def merge_eligible(pools, exclude=()):
+    ''' Returns the ids of the sorted arrays pools not in exclude, in order '''
+    return array('l', (question_id for question_id in heapq.merge(*pools)
+                       if question_id not in exclude))
+
+
+class QuestionIndex:
+    ''' In-memory index of question ids used to draw random quiz questions.
+
+    Holds a sorted id array per (category, difficulty) bucket plus one for
+    the whole bank. A QuestionFilter selects a set of buckets, which a draw
+    samples weighted by their sizes. The index is loaded with a single query
+    on first use and kept current through model change notifications, so a
+    draw never has to fetch or format the questions it does not return.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._all_ids = None
+        self._buckets = None
+
+    def _load(self):
+        all_ids = array('l')
+        buckets = {}
+        rows = db.session.query(Question.id, Question.category,
+                                Question.difficulty).order_by(Question.id)
+        for question_id, category_id, difficulty in rows:
+            all_ids.append(question_id)
+            buckets.setdefault((category_id, difficulty),
+                               array('l')).append(question_id)
+        self._all_ids = all_ids
+        self._buckets = buckets
+
+    def _pools(self, question_filter):
+        with self._lock:
+            if self._all_ids is None:
+                self._load()
+            return [
+                self._buckets[bucket]
+                for bucket in sorted(self._buckets, key=bucket_order)
+                if question_filter.includes(*bucket)
+            ]
+
+    def add(self, question_id, category_id, difficulty):
+        with self._lock:
+            if self._all_ids is None or _contains(self._all_ids, question_id):
+                return
+            insort(self._all_ids, question_id)
+            insort(self._buckets.setdefault((category_id, difficulty),
+                                            array('l')),
+                   question_id)
+
+    def remove(self, question_id, category_id=None, difficulty=None):
+        ''' Removes question_id, from every bucket unless its category and
+        difficulty are both given.
+        '''
+        with self._lock:
+            if self._all_ids is None:
+                return
+            pools = [self._all_ids]
+            if category_id is None or difficulty is None:
+                pools.extend(self._buckets.values())
+            elif (category_id, difficulty) in self._buckets:
+                pools.append(self._buckets[(category_id, difficulty)])
+            for ids in pools:
+                position = bisect_left(ids, question_id)
+                if position < len(ids) and ids[position] == question_id:
+                    del ids[position]
+
+    def clear(self):
+        with self._lock:
+            self._all_ids = None
+            self._buckets = None
+
+    def count(self, question_filter, exclude=()):
+        ''' Returns the number of ids matching question_filter not in exclude '''
+        return count_eligible(self._pools(question_filter), exclude)
+
+    def eligible(self, question_filter, exclude=()):
+        ''' Returns the sorted ids matching question_filter not in exclude '''
+        return merge_eligible(self._pools(question_filter), exclude)
+
+    def pick(self, question_filter, exclude=(), rng=random):
+        ''' Draws a random question id matching question_filter.
+
+        See pick_eligible() for the sampling and the return value.
+        '''
+        return pick_eligible(self._pools(question_filter), exclude, rng)
+
+    def fetch(self, question_ids):
+        ''' Returns the formatted questions with question_ids by id.
+
+        Questions no longer in the database are left out. Those missing from
+        a read replica are looked up again on the primary, as the replica may
+        not have caught up with their insert yet.
+        '''
+        fetched = self._fetch(question_ids)
+        missing = [question_id for question_id in question_ids
+                   if question_id not in fetched]
+        if missing and reading_from_replica():
+            with primary_reads():
+                fetched.update(self._fetch(missing))
+        return fetched
+
+    def _fetch(self, question_ids):
+        rows = question_rows(Question.query).filter(
+            Question.id.in_(list(question_ids)))
+        return {row[0]: format_row(row) for row in rows}
+
+
+question_index = QuestionIndex()
+
+
+@on_change
+def update_question_index(table, action, record, previous):
+    if table == 'categories':
+        # Questions of a deleted category are moved out of it by the database
+        if action in ('delete', 'reset'):
+            question_index.clear()
+    elif action == 'reset':
+        question_index.clear()
+    elif action == 'insert':
+        question_index.add(record['id'], record['category'],
+                           record['difficulty'])
+    elif action == 'delete':
+        question_index.remove(record['id'], record['category'],
+                              record['difficulty'])
+    elif action == 'update':
+        question_index.remove(previous['id'], previous['category'],
+                              previous['difficulty'])
+        question_index.add(record['id'], record['category'],
+                           record['difficulty'])
+
+
+def draw_questions(question_filter, previous_questions, count=1,
+                   rng=random, index=question_index):
+    ''' Returns up to count distinct random questions matching question_filter
+    and not in previous_questions, and how many remain after them.
+
+    The ids are drawn from index, question_index or a QuestionSnapshot, and
+    their questions fetched together and returned formatted. Ids whose
+    question has since disappeared from the primary database are dropped
+    from the index and drawn again.
+    '''
+    exclude = set(previous_questions or ())
+    questions = []
+    remaining = index.count(question_filter, exclude)
+    while len(questions) < count:
+        question_ids = []
+        while len(questions) + len(question_ids) < count:
+            question_id, remaining = index.pick(question_filter, exclude, rng)
+            if question_id is None:
+                break
+            exclude.add(question_id)
+            question_ids.append(question_id)
+
+        if not question_ids:
+            break
+
+        fetched = index.fetch(question_ids)
+        for question_id in question_ids:
+            if question_id in fetched:
+                questions.append(fetched[question_id])
+            else:
+                index.remove(question_id)
+
+    return questions, remaining
+
+
+def draw_question(question_filter, previous_questions, rng=random,
+                  index=question_index):
+    ''' Returns a random question not in previous_questions and how many remain.
+
+    See draw_questions(), the question is None once none are left.
+    '''
+    questions, remaining = draw_questions(question_filter,
+                                          previous_questions, 1, rng, index)
+    return (questions[0] if questions else None), remaining
+
+
+class QuizSession:
+    ''' Server side state of one quiz: its question filter and the ids asked
+    so far.
+
+    Draws sample the index like stateless quiz requests do, excluding the ids
+    asked, so a session holds no more than the questions it has asked,
+    whatever the size of the bank, and pickles to a few bytes for shared
+    stores. A seed makes the draws repeatable.
+    '''
+    __slots__ = ('question_filter', 'asked', 'seed', 'remaining')
+
+    def __init__(self, question_filter, previous_questions=(), seed=None,
+                 index=question_index):
+        self.question_filter = question_filter
+        self.asked = array('l', previous_questions or ())
+        self.seed = secrets.randbits(64) if seed is None else seed
+        self.remaining = index.count(question_filter, set(self.asked))
+
+    def next_questions(self, count=1, index=question_index):
+        ''' Returns up to count next formatted questions still in index '''
+        # Seeded per draw, so a session restored from a copy draws the same
+        rng = random.Random(f'{self.seed}:{len(self.asked)}')
+        questions, self.remaining = draw_questions(
+            self.question_filter, self.asked, count, rng, index)
+        self.asked.extend(question['id'] for question in questions)
+        return questions
+
+    def next_question(self, index=question_index):
+        ''' Returns the next formatted question still in index, or None at the end '''
+        questions = self.next_questions(1, index)
+        return questions[0] if questions else None
+
+
+def start_session(store, question_filter, previous_questions, rng=random,
+                  index=question_index):
+    ''' Creates a quiz session in store for the eligible questions of index.
+
+    Returns:
+        The new quiz id and its session.
+    '''
+    session = QuizSession(question_filter, previous_questions,
+                          rng.getrandbits(64), index)
+    quiz_id = secrets.token_urlsafe(16)
+    store.set(quiz_id, session)
+    return quiz_id, session
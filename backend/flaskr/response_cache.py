@@ -0,0 +1,191 @@
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+from models import on_change
+from .serialization import QUESTION_FIELDS, parse_fields
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+ALL_QUESTIONS = 'all'
+
+
+def category_scope(category_id):
+    return f'category:{category_id}'
+
+
+class ResponseCacheBackend:
+    ''' Storage interface for serialized page responses.
+
+    Keys are strings. Every entry belongs to one scope (all questions or a
+    single category) so writes can evict only the pages they affect. A shared
+    cache only has to implement these four methods.
+    '''
+
+    def get(self, key):
+        ''' Returns the cached body for key or None '''
+        raise NotImplementedError
+
+    def set(self, key, body, scope):
+        raise NotImplementedError
+
+    def evict_scope(self, scope):
+        ''' Drops every entry stored under scope '''
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUResponseCache(ResponseCacheBackend):
+    ''' In-process backend evicting least recently used entries past max_bytes '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._scopes = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        body, scope = self._entries.pop(key)
+        self.size -= len(body)
+        keys = self._scopes[scope]
+        keys.discard(key)
+        if not keys:
+            del self._scopes[scope]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, body, scope):
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            while self.size + len(body) > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+            self._entries[key] = (body, scope)
+            self._scopes.setdefault(scope, set()).add(key)
+            self.size += len(body)
+
+    def evict_scope(self, scope):
+        with self._lock:
+            for key in list(self._scopes.get(scope, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+            self.size = 0
+
+
+class PageCache:
+    ''' Caches serialized question pages in front of a ResponseCacheBackend.
+
+    Keys carry the revision of their scope, which writes to that scope bump,
+    so an entry can never be served once the pages it holds have changed.
+    Writes also evict the stale entries right away instead of leaving them
+    to age out.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._revisions = {}
+
+    def _revision(self, scope):
+        return f'{self._generation}.{self._revisions.get(scope, 0)}'
+
+    def key(self, endpoint, scope, page, per_page, fields=QUESTION_FIELDS):
+        return (f'{endpoint}:{scope}:{page}:{per_page}:{",".join(fields)}:'
+                f'{self._revision(scope)}')
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, body, scope):
+        # A key computed before a concurrent write must not be stored
+        if key.endswith(':' + self._revision(scope)):
+            self.backend.set(key, body, scope)
+
+    def invalidate(self, *scopes):
+        with self._lock:
+            for scope in scopes:
+                self._revisions[scope] = self._revisions.get(scope, 0) + 1
+        for scope in scopes:
+            self.backend.evict_scope(scope)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._revisions.clear()
+        self.backend.clear()
+
+
+page_cache = PageCache(LRUResponseCache())
+
+
+@on_change
+def evict_page_cache(table, action, record, previous):
+    if table == 'questions' and action != 'reset':
+        scopes = {ALL_QUESTIONS, category_scope(record['category'])}
+        if previous is not None:
+            scopes.add(category_scope(previous['category']))
+        page_cache.invalidate(*scopes)
+    else:
+        # Category writes change the category map embedded in every page
+        page_cache.clear()
+
+
+def cached_page(per_page):
+    ''' Serves a paginated question listing view from page_cache.
+
+    Only ?page= requests, optionally with a fields projection, are cached; any
+    other query parameter bypasses the cache. Views taking a category_id are
+    cached in that category's scope.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if set(request.args) - {'page', 'fields'}:
+                return view(*args, **kwargs)
+            try:
+                fields = parse_fields(request.args.get('fields'))
+            except ValueError:
+                # Left to the view to reject
+                return view(*args, **kwargs)
+
+            category_id = kwargs.get('category_id')
+            scope = (ALL_QUESTIONS if category_id is None
+                     else category_scope(category_id))
+            key = page_cache.key(request.endpoint, scope,
+                                 request.args.get('page', 1, type=int),
+                                 per_page, fields)
+
+            body = page_cache.get(key)
+            if body is not None:
+                return current_app.response_class(
+                    body, mimetype='application/json')
+
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                page_cache.set(key, response.get_data(), scope)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,222 @@
+import re
+import threading
+from array import array
+from bisect import bisect_left, insort
+
+from sqlalchemy import func
+
+from migrations import SEARCH_CONFIG
+from models import db, on_change, Question
+from .serialization import (QUESTION_FIELDS, format_rows, project_rows,
+                            question_rows)
+
+# Word characters without the underscore, which to_tsquery splits words on
+_TOKEN = re.compile(r'[^\W_]+')
+
+
+def tokenize(value):
+    ''' Returns the lower cased word tokens of value '''
+    return _TOKEN.findall((value or '').lower())
+
+
+def search_document():
+    ''' Returns the tsvector expression the PostgreSQL search index is built on.
+
+    Must match the index created by migrations.create_search_index().
+    '''
+    return func.to_tsvector(SEARCH_CONFIG,
+                            func.coalesce(Question.question, ''))
+
+
+class InvertedIndex:
+    ''' In-process full-text index mapping tokens to sorted question id postings.
+
+    Used when the database has no native full-text search. Every query token
+    matches indexed tokens it is a prefix of, results must match all query
+    tokens and are ranked by how many of them match a whole word.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = None
+        self._terms = []
+        self._documents = {}
+
+    @property
+    def loaded(self):
+        return self._postings is not None
+
+    def load(self, documents):
+        ''' Replaces the index contents with (id, text) pairs '''
+        with self._lock:
+            self._postings = {}
+            self._terms = []
+            self._documents = {}
+            for question_id, value in documents:
+                self._add(question_id, value)
+
+    def _add(self, question_id, value):
+        tokens = frozenset(tokenize(value))
+        self._documents[question_id] = tokens
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = array('l')
+                insort(self._terms, token)
+            insort(postings, question_id)
+
+    def _remove(self, question_id):
+        for token in self._documents.pop(question_id, ()):
+            postings = self._postings[token]
+            del postings[bisect_left(postings, question_id)]
+            if not postings:
+                del self._postings[token]
+                del self._terms[bisect_left(self._terms, token)]
+
+    def add(self, question_id, value):
+        with self._lock:
+            if self._postings is not None:
+                self._remove(question_id)
+                self._add(question_id, value)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._postings is not None:
+                self._remove(question_id)
+
+    def clear(self):
+        with self._lock:
+            self._postings = None
+            self._terms = []
+            self._documents = {}
+
+    def search(self, value):
+        ''' Returns the ids of questions matching value, best match first '''
+        tokens = set(tokenize(value))
+        if not tokens:
+            return []
+
+        with self._lock:
+            scores = None
+            for token in tokens:
+                token_scores = {}
+                start = bisect_left(self._terms, token)
+                for term in self._terms[start:]:
+                    if not term.startswith(token):
+                        break
+                    weight = 2 if term == token else 1
+                    for question_id in self._postings[term]:
+                        if token_scores.get(question_id, 0) < weight:
+                            token_scores[question_id] = weight
+
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {
+                        question_id: score + token_scores[question_id]
+                        for question_id, score in scores.items()
+                        if question_id in token_scores
+                    }
+                if not scores:
+                    return []
+
+        return sorted(scores, key=lambda question_id:
+                      (-scores[question_id], question_id))
+
+
+search_index = InvertedIndex()
+
+
+@on_change
+def update_search_index(table, action, record, previous):
+    if table not in (None, 'questions'):
+        return
+
+    if action == 'reset':
+        search_index.clear()
+    elif action in ('insert', 'update'):
+        search_index.add(record['id'], record['question'])
+    elif action == 'delete':
+        search_index.remove(record['id'])
+
+
+def _search_postgresql(search_term, start, limit, fields):
+    tokens = tokenize(search_term)
+    if not tokens:
+        return 0, []
+
+    query = func.to_tsquery(SEARCH_CONFIG,
+                            ' & '.join(f'{token}:*' for token in tokens))
+    # n tokens joined with & make 2n - 1 nodes, unless some were stopwords.
+    # The full-text search drops those and would match far more than asked,
+    # such terms are matched as a substring instead, as before it
+    if db.session.query(func.numnode(query)).scalar() < 2 * len(tokens) - 1:
+        literal = re.sub(r'([\\%_])', r'\\\1', search_term)
+        matches = Question.query.filter(
+            Question.question.ilike(f'%{literal}%', escape='\\'))
+        ranking = (Question.id,)
+    else:
+        document = search_document()
+        matches = Question.query.filter(document.op('@@')(query))
+        ranking = (func.ts_rank(document, query).desc(), Question.id)
+
+    total = matches.count()
+    questions = question_rows(matches, fields).order_by(
+        *ranking).offset(start).limit(limit).all()
+    return total, questions
+
+
+def _search_index(search_term, start, limit, fields):
+    if not search_index.loaded:
+        search_index.load(db.session.query(Question.id, Question.question))
+
+    question_ids = search_index.search(search_term)
+    page_ids = question_ids[start:start + limit]
+    if not page_ids:
+        return len(question_ids), []
+
+    questions = question_rows(Question.query, fields).filter(
+        Question.id.in_(page_ids)).all()
+    questions.sort(key=lambda row: page_ids.index(row[0]))
+    return len(question_ids), questions
+
+
+def _search_snapshot(snapshot, search_term, start, limit, fields):
+    if not search_index.loaded:
+        search_index.load(snapshot.documents())
+
+    question_ids = search_index.search(search_term)
+    questions = [snapshot.get(question_id)
+                 for question_id in question_ids[start:start + limit]]
+    return len(question_ids), project_rows(
+        [row for row in questions if row is not None], fields)
+
+
+def search_questions(search_term, page, per_page, snapshot=None,
+                     fields=QUESTION_FIELDS):
+    ''' Runs a ranked full-text search over question text.
+
+    Uses the GIN backed tsvector search on PostgreSQL and the in-process
+    inverted index everywhere else, or when a QuestionSnapshot is given, in
+    which case the questions come from the snapshot too. Word prefixes match,
+    e.g. "tit" finds "title", and all words of the search term must match.
+
+    Returns:
+        A tuple of the total number of matches and the formatted questions on
+        the requested page, limited to fields.
+    '''
+    start = (page - 1) * per_page
+    if start < 0:
+        return 0, []
+
+    if snapshot is not None:
+        total, questions = _search_snapshot(snapshot, search_term, start,
+                                            per_page, fields)
+    elif db.engine.dialect.name == 'postgresql':
+        total, questions = _search_postgresql(search_term, start, per_page,
+                                              fields)
+    else:
+        total, questions = _search_index(search_term, start, per_page,
+                                         fields)
+
+    return total, format_rows(questions, fields)
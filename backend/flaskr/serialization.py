@@ -0,0 +1,116 @@
+import json
+
+from flask import current_app
+from flask.json import JSONEncoder
+
+from models import Question
+from .instrumentation import timed
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+# Fields of a serialized question and their columns, in the order question
+# rows are selected
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty)
+_FIELD_COLUMNS = dict(zip(QUESTION_FIELDS, QUESTION_COLUMNS))
+
+
+def dumps(value):
+    ''' Returns value encoded as compact UTF-8 JSON bytes.
+
+    Uses orjson when it is installed and the stdlib encoder otherwise. Non
+    string dictionary keys, like category ids, are written as strings by both.
+    '''
+    with timed('serialize'):
+        if orjson is not None:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(value, separators=(',', ':'),
+                          ensure_ascii=False).encode('utf-8')
+
+
+class FastJSONEncoder(JSONEncoder):
+    ''' Flask JSON encoder handing the encoding to orjson when it is installed.
+
+    Values orjson cannot encode natively, such as dates, go through Flask's
+    default() so jsonify output keeps its format. Pretty printed output, and
+    every call when orjson is missing, use the stdlib encoder.
+    '''
+
+    def encode(self, o):
+        with timed('serialize'):
+            if orjson is None or self.indent is not None:
+                return super().encode(o)
+
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(o, default=self.default,
+                                option=option).decode('utf-8')
+
+
+def parse_fields(value):
+    ''' Returns the question fields named by a comma separated fields parameter.
+
+    The fields come back in QUESTION_FIELDS order and always include id, which
+    cursors and search ordering rely on. An empty value selects every field.
+
+    Raises:
+        ValueError if a name is not a question field.
+    '''
+    if not value:
+        return QUESTION_FIELDS
+
+    names = set(value.split(','))
+    unknown = names.difference(QUESTION_FIELDS)
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+    names.add('id')
+    fields = tuple(field for field in QUESTION_FIELDS if field in names)
+    return QUESTION_FIELDS if fields == QUESTION_FIELDS else fields
+
+
+def question_rows(query, fields=QUESTION_FIELDS):
+    ''' Returns query narrowed to the columns of the serialized fields.
+
+    The rows are plain tuples, so no Question objects are built for them, and
+    columns left out of fields are not read from the database at all.
+    '''
+    return query.with_entities(*(_FIELD_COLUMNS[field] for field in fields))
+
+
+def project_rows(rows, fields):
+    ''' Returns complete question_rows() rows narrowed to fields '''
+    if fields == QUESTION_FIELDS:
+        return list(rows)
+    positions = [QUESTION_FIELDS.index(field) for field in fields]
+    return [tuple(row[position] for position in positions) for row in rows]
+
+
+def format_row(row, fields=QUESTION_FIELDS):
+    ''' Returns a question_rows() row in the shape of Question.format(),
+    limited to fields.
+    '''
+    if fields is not QUESTION_FIELDS:
+        return dict(zip(fields, row))
+    return {
+        'id': row[0],
+        'question': row[1],
+        'answer': row[2],
+        'category': row[3],
+        'difficulty': row[4]
+    }
+
+
+def format_rows(rows, fields=QUESTION_FIELDS):
+    with timed('serialize'):
+        return [format_row(row, fields) for row in rows]
+
+
+def json_response(payload, status=200):
+    ''' Returns a JSON response of payload encoded by dumps() '''
+    return current_app.response_class(dumps(payload) + b'\n', status=status,
+                                      mimetype='application/json')
@@ -0,0 +1,297 @@
+import heapq
+import random
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+
+from flask import current_app
+
+from models import on_change, Question
+from .quiz import (bucket_order, count_eligible, merge_eligible,
+                   pick_eligible)
+from .serialization import (QUESTION_FIELDS, format_row, project_rows,
+                            question_rows)
+
+# Stored for questions without a category or difficulty, both start at 1
+NO_CATEGORY = 0
+NO_DIFFICULTY = 0
+
+
+def _tail(ids, start):
+    ''' Yields ids from position start on without copying the array '''
+    for position in range(start, len(ids)):
+        yield ids[position]
+
+
+class QuestionSnapshot:
+    ''' Read mostly, in-memory copy of the whole question bank.
+
+    Questions are kept in columns ordered by id: typed arrays for the ids,
+    category ids and difficulties and plain lists for the text, so a question
+    costs a few bytes beyond its strings instead of an ORM object and its
+    instance state. Each category also has a sorted id array, which listings
+    page through, and so has each (category, difficulty) bucket, which
+    filtered listings merge and quizzes draw from.
+
+    The snapshot is loaded with one query on first use and kept current
+    through model change notifications. It serves listings, quizzes and
+    search when the QUESTION_SNAPSHOT setting is on.
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ids = None
+        self._categories = None
+        self._difficulties = None
+        self._questions = None
+        self._answers = None
+        self._by_category = None
+        self._buckets = None
+
+    @property
+    def loaded(self):
+        return self._ids is not None
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._ids)
+
+    def load(self, rows):
+        ''' Replaces the snapshot contents with question_rows() rows '''
+        with self._lock:
+            self._ids = array('l')
+            # Wide enough for any value of the 32 bit category and difficulty
+            # columns
+            self._categories = array('i')
+            self._difficulties = array('i')
+            self._questions = []
+            self._answers = []
+            self._by_category = {}
+            self._buckets = {}
+            try:
+                for row in sorted(rows, key=lambda row: row[0]):
+                    self._insert(len(self._ids), row)
+            except Exception:
+                self.clear()
+                raise
+
+    def _ensure_loaded(self):
+        if self._ids is None:
+            self.load(question_rows(Question.query).all())
+
+    def _insert(self, position, row):
+        question_id, question, answer, category_id, difficulty = row
+        # Converted up front, so a value out of range for its array raises
+        # before any column has changed
+        typed = (array('l', (question_id,)),
+                 array('i', (NO_CATEGORY if category_id is None
+                             else category_id,)),
+                 array('i', (NO_DIFFICULTY if difficulty is None
+                             else difficulty,)))
+        for column, value in zip((self._ids, self._categories,
+                                  self._difficulties), typed):
+            column[position:position] = value
+        self._questions.insert(position, question)
+        self._answers.insert(position, answer)
+        if category_id is not None:
+            insort(self._by_category.setdefault(category_id, array('l')),
+                   question_id)
+        insort(self._buckets.setdefault((category_id, difficulty),
+                                        array('l')),
+               question_id)
+
+    def _position(self, question_id):
+        position = bisect_left(self._ids, question_id)
+        if position < len(self._ids) and self._ids[position] == question_id:
+            return position
+        return None
+
+    def _bucket(self, position):
+        category_id = self._categories[position]
+        difficulty = self._difficulties[position]
+        return (None if category_id == NO_CATEGORY else category_id,
+                None if difficulty == NO_DIFFICULTY else difficulty)
+
+    def _row(self, position):
+        category_id, difficulty = self._bucket(position)
+        return (self._ids[position], self._questions[position],
+                self._answers[position], category_id, difficulty)
+
+    def _remove(self, question_id):
+        position = self._position(question_id)
+        if position is None:
+            return
+
+        bucket = self._bucket(position)
+        for ids in (self._by_category.get(bucket[0]),
+                    self._buckets.get(bucket)):
+            if ids is not None:
+                del ids[bisect_left(ids, question_id)]
+        for column in (self._ids, self._categories, self._difficulties,
+                       self._questions, self._answers):
+            del column[position]
+
+    def put(self, record):
+        ''' Inserts or replaces a question given as a Question.format() dict '''
+        with self._lock:
+            if self._ids is None:
+                return
+            try:
+                self._remove(record['id'])
+                self._insert(bisect_left(self._ids, record['id']),
+                             (record['id'], record['question'],
+                              record['answer'], record['category'],
+                              record['difficulty']))
+            except Exception:
+                # Reloaded from the database on next use
+                self.clear()
+                raise
+
+    def remove(self, question_id, category_id=None):
+        with self._lock:
+            if self._ids is not None:
+                self._remove(question_id)
+
+    def clear(self):
+        with self._lock:
+            self._ids = None
+            self._categories = None
+            self._difficulties = None
+            self._questions = None
+            self._answers = None
+            self._by_category = None
+            self._buckets = None
+
+    def _pools(self, question_filter):
+        ''' Returns the disjoint sorted id arrays making up question_filter '''
+        self._ensure_loaded()
+        if not question_filter.bounds_difficulty:
+            if question_filter.categories is None:
+                return [self._ids]
+            return [self._by_category[category_id]
+                    for category_id in sorted(question_filter.categories)
+                    if category_id in self._by_category]
+        return [
+            self._buckets[bucket]
+            for bucket in sorted(self._buckets, key=bucket_order)
+            if question_filter.includes(*bucket)
+        ]
+
+    def get(self, question_id):
+        ''' Returns the question_rows() row of question_id, or None '''
+        with self._lock:
+            self._ensure_loaded()
+            position = self._position(question_id)
+            return None if position is None else self._row(position)
+
+    def fetch(self, question_ids):
+        ''' Returns the formatted questions with question_ids by id '''
+        with self._lock:
+            self._ensure_loaded()
+            positions = [self._position(question_id)
+                         for question_id in question_ids]
+            return {
+                self._ids[position]: format_row(self._row(position))
+                for position in positions if position is not None
+            }
+
+    def count(self, question_filter, exclude=()):
+        ''' Returns the number of ids matching question_filter not in exclude '''
+        with self._lock:
+            return count_eligible(self._pools(question_filter), exclude)
+
+    def eligible(self, question_filter, exclude=()):
+        ''' Returns the sorted ids matching question_filter not in exclude '''
+        with self._lock:
+            return merge_eligible(self._pools(question_filter), exclude)
+
+    def pick(self, question_filter, exclude=(), rng=random):
+        ''' Draws a random question id matching question_filter.
+
+        See quiz.pick_eligible() for the sampling and the return value.
+        '''
+        with self._lock:
+            return pick_eligible(self._pools(question_filter), exclude, rng)
+
+    def _rows(self, question_ids, fields):
+        return project_rows((self._row(self._position(question_id))
+                             for question_id in question_ids), fields)
+
+    def page(self, question_filter, start, limit, fields=QUESTION_FIELDS):
+        ''' Returns the number of questions matching question_filter and limit
+        of their rows from start, in id order, narrowed to fields.
+        '''
+        with self._lock:
+            pools = self._pools(question_filter)
+            total = sum(len(ids) for ids in pools)
+            if start < 0:
+                return total, []
+            if len(pools) == 1:
+                return total, self._rows(pools[0][start:start + limit],
+                                         fields)
+            return total, self._rows(
+                islice(heapq.merge(*pools), start, start + limit), fields)
+
+    def page_after(self, question_filter, after, limit,
+                   fields=QUESTION_FIELDS):
+        ''' Returns up to limit rows matching question_filter with an id greater
+        than after, or from the start if after is None, narrowed to fields.
+        '''
+        with self._lock:
+            pools = self._pools(question_filter)
+            starts = [0 if after is None else bisect_right(ids, after)
+                      for ids in pools]
+            if len(pools) == 1:
+                return self._rows(pools[0][starts[0]:starts[0] + limit],
+                                  fields)
+            return self._rows(islice(heapq.merge(*[
+                _tail(ids, start) for ids, start in zip(pools, starts)
+            ]), limit), fields)
+
+    def documents(self):
+        ''' Returns (id, question text) pairs of every question '''
+        with self._lock:
+            self._ensure_loaded()
+            return list(zip(self._ids, self._questions))
+
+    def memory_usage(self):
+        ''' Returns the bytes held by the snapshot, strings included '''
+        with self._lock:
+            self._ensure_loaded()
+            size = sum(sys.getsizeof(column) for column in (
+                self._ids, self._categories, self._difficulties,
+                self._questions, self._answers, self._by_category,
+                self._buckets))
+            size += sum(sys.getsizeof(ids)
+                        for ids in self._by_category.values())
+            size += sum(sys.getsizeof(ids) for ids in self._buckets.values())
+            size += sum(sys.getsizeof(value) for value in self._questions)
+            size += sum(sys.getsizeof(value) for value in self._answers)
+            return size
+
+
+question_snapshot = QuestionSnapshot()
+
+
+@on_change
+def update_question_snapshot(table, action, record, previous):
+    if table == 'categories':
+        # Category id changes and deletes cascade into the questions
+        if action != 'insert':
+            question_snapshot.clear()
+    elif action == 'reset':
+        question_snapshot.clear()
+    elif action in ('insert', 'update'):
+        question_snapshot.put(record)
+    elif action == 'delete':
+        question_snapshot.remove(record['id'])
+
+
+def active_snapshot():
+    ''' Returns question_snapshot if the app serves reads from it, else None '''
+    if current_app.config.get('QUESTION_SNAPSHOT'):
+        return question_snapshot
+    return None
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLStore:
+    ''' Bounded in-process key/value store whose entries expire after ttl seconds.
+
+    Reading or writing an entry renews its lease, so entries stay ordered by
+    expiry and expired ones are evicted from the front as the store is used.
+    Once max_entries is reached the entry closest to expiring is dropped.
+
+    Anything exposing get, set and pop with the same signatures can stand in
+    for it. Values are written back with set() after every change, so stores
+    that hand out copies work too. Entries live in one process, so
+    multi-process deployments need a shared store, or quiz ids only work on
+    the worker that created them.
+    '''
+
+    def __init__(self, ttl, max_entries=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            self._evict_expired()
+            return len(self._entries)
+
+    def _evict_expired(self):
+        now = self._clock()
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[key]
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._evict_expired()
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)[1]
+            self._entries[key] = (self._clock() + self.ttl, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._evict_expired()
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[key] = (self._clock() + self.ttl, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self._clock():
+                return default
+            return entry[1]
@@ -0,0 +1,129 @@
+import uuid
+
+from sqlalchemy import text
+
+'''
+migrations
+    ordered, idempotent schema changes. upgrade() applies the ones a database
+    has not seen yet and records each in the schema_version table.
+'''
+
+# Keep in sync with flaskr.search.search_document()
+SEARCH_CONFIG = 'english'
+SEARCH_INDEX_NAME = 'ix_questions_question_search'
+
+# Serializes upgrades of workers booting at the same time on PostgreSQL
+UPGRADE_LOCK_ID = 7340917
+
+
+def create_tables(connection, metadata):
+    metadata.create_all(bind=connection)
+
+
+def make_question_category_integer(connection, metadata):
+    # SQLite columns are loosely typed, only PostgreSQL needs converting
+    if connection.dialect.name != 'postgresql':
+        return
+
+    data_type = connection.execute(
+        text("SELECT data_type FROM information_schema.columns "
+             "WHERE table_name = 'questions' AND column_name = 'category'")
+    ).scalar()
+    if data_type != 'integer':
+        connection.execute(
+            text("ALTER TABLE questions ALTER COLUMN category TYPE integer "
+                 "USING category::integer"))
+
+
+def create_question_indexes(connection, metadata):
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_questions_category_id "
+             "ON questions (category, id)"))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_questions_difficulty "
+             "ON questions (difficulty)"))
+
+
+def create_search_index(connection, metadata):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.execute(
+        text(f"CREATE INDEX IF NOT EXISTS {SEARCH_INDEX_NAME} ON questions "
+             f"USING gin (to_tsvector('{SEARCH_CONFIG}', "
+             f"coalesce(question, '')))"))
+
+
+def create_bank_revision(connection, metadata):
+    # A single row shared by every worker, the epoch tells databases apart
+    connection.execute(
+        text("CREATE TABLE IF NOT EXISTS bank_revision ("
+             "id INTEGER PRIMARY KEY, epoch VARCHAR NOT NULL, "
+             "value BIGINT NOT NULL)"))
+    connection.execute(
+        text("INSERT INTO bank_revision (id, epoch, value) "
+             "SELECT 1, :epoch, 0 "
+             "WHERE NOT EXISTS (SELECT 1 FROM bank_revision)"),
+        epoch=uuid.uuid4().hex[:12])
+
+
+MIGRATIONS = [
+    (1, 'create tables', create_tables),
+    (2, 'make questions.category an integer', make_question_category_integer),
+    (3, 'index questions by (category, id) and difficulty',
+     create_question_indexes),
+    (4, 'full-text search index on questions.question', create_search_index),
+    (5, 'shared bank revision', create_bank_revision),
+]
+
+
+def applied_versions(engine):
+    ''' Returns the set of migration versions recorded in the database '''
+    with engine.connect() as connection:
+        if not engine.dialect.has_table(connection, 'schema_version'):
+            return set()
+        return {
+            row[0]
+            for row in connection.execute(
+                text('SELECT version FROM schema_version'))
+        }
+
+
+def upgrade(engine, metadata):
+    ''' Applies every migration the database has not recorded yet.
+
+    Each migration runs in its own transaction together with its
+    schema_version row, so an interrupted upgrade resumes where it failed.
+
+    Returns:
+        The versions applied by this call.
+    '''
+    recorded = applied_versions(engine)
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version in recorded:
+            continue
+
+        with engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                connection.execute(text('SELECT pg_advisory_xact_lock(:id)'),
+                                   id=UPGRADE_LOCK_ID)
+            connection.execute(
+                text('CREATE TABLE IF NOT EXISTS schema_version ('
+                     'version INTEGER PRIMARY KEY, '
+                     'description VARCHAR NOT NULL)'))
+
+            done = connection.execute(
+                text('SELECT 1 FROM schema_version WHERE version = :version'),
+                version=version).scalar()
+            if done:
+                continue
+
+            migrate(connection, metadata)
+            connection.execute(
+                text('INSERT INTO schema_version (version, description) '
+                     'VALUES (:version, :description)'),
+                version=version, description=description)
+            applied.append(version)
+
+    return applied
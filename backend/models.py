@@ -1,24 +1,237 @@
+import logging
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import (Column, ForeignKey, Index, String, Integer,
+                        create_engine, event, inspect)
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import column, select, table
 import json
 
+from engine_config import engine_options, load_engine_config
+from migrations import upgrade
+from read_replicas import (RoutingSQLAlchemy, configure_replicas, note_change,
+                           primary_reads)
+
 database_name = "trivia"
 database_path = "postgresql:///{}".format(database_name)
+DEFAULT_DATABASE_PATH = database_path
+
+CATEGORY_CACHE_TTL = 5 * 60
+
+logger = logging.getLogger(__name__)
+
+db = RoutingSQLAlchemy()
+
+'''
+change_listeners
+    callables notified after a write to the bank has been committed
+'''
+change_listeners = []
+
+
+def on_change(listener):
+    '''Registers listener(table, action, record, previous) for committed writes.
+
+    action is one of insert, update, delete or reset. A reset (record None)
+    means the contents of table, or of every table if table is None, may have
+    changed wholesale and anything derived from them should be rebuilt.
+    '''
+    change_listeners.append(listener)
+    return listener
+
+
+def notify_change(table, action, record=None, previous=None):
+    '''Calls every listener with a committed write.
+
+    A failing listener is logged and does not keep the others from running.
+    The write is committed by then, so the listeners are sent a reset of
+    table instead, and whatever they derived from it is rebuilt.
+    '''
+    if not _call_listeners(table, action, record, previous) and \
+            action != 'reset':
+        _call_listeners(table, 'reset', None, None)
+
+
+def _call_listeners(table, action, record, previous):
+    succeeded = True
+    for listener in list(change_listeners):
+        try:
+            listener(table, action, record, previous)
+        except Exception:
+            logger.exception('Change listener %r failed on %s %s',
+                             listener, action, table)
+            succeeded = False
+    return succeeded
+
+
+'''
+unit_of_work()
+    groups the model writes made in its block into one transaction. insert(),
+    update() and delete() are left pending while a unit of work is open and
+    flushed together when the block ends, so SQLAlchemy batches them into as
+    few statements as it can. The block commits once on exit, or rolls back
+    if it raises, and change notifications are sent after the commit. Nested
+    units of work join the outermost one.
+'''
+
+UNIT_OF_WORK = 'trivia.unit_of_work'
+
+
+@contextmanager
+def unit_of_work():
+    info = db.session.info
+    if UNIT_OF_WORK in info:
+        yield
+        return
+
+    pending = info[UNIT_OF_WORK] = []
+    try:
+        yield
+        db.session.flush()
+        changes = [(table, action, record() if callable(record) else record,
+                    previous) for table, action, record, previous in pending]
+        if changes:
+            bump_stored_revision()
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        del info[UNIT_OF_WORK]
+
+    for change in changes:
+        notify_change(*change)
+
+
+def commit_change(table, action, record=None, previous=None):
+    '''Commits a model write and notifies it, or defers both to the open
+    unit of work.
+
+    record may be a callable returning the record once the write has been
+    flushed, for writes that need their generated id.
+    '''
+    pending = db.session.info.get(UNIT_OF_WORK)
+    if pending is None:
+        if callable(record):
+            db.session.flush()
+            record = record()
+        bump_stored_revision()
+        db.session.commit()
+        notify_change(table, action, record, previous)
+    else:
+        pending.append((table, action, record, previous))
+
+
+'''
+BankRevision
+    revision of the question bank, kept in the bank_revision row that every
+    committed write bumps in its own transaction, so all workers tag the same
+    contents with the same ETag. Each worker caches the revision until it
+    hears of a change, so read responses are validated without a query.
+'''
+
+
+# Created by the migrations, outside the metadata of the models
+stored_revision = table('bank_revision', column('epoch'), column('value'))
+
+
+def bump_stored_revision():
+    '''Bumps the shared bank revision within the open transaction'''
+    db.session.execute(stored_revision.update().values(
+        value=stored_revision.c.value + 1))
+
+
+class BankRevision:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Counts the changes heard of, a read racing one is not kept
+        self._changes = 0
+        self._etag = None
+
+    def bump(self):
+        '''Forgets the cached revision, read again by the next etag()'''
+        with self._lock:
+            self._changes += 1
+            self._etag = None
+
+    def etag(self):
+        '''Returns an entity tag identifying the current revision'''
+        with self._lock:
+            etag, changes = self._etag, self._changes
+        if etag is not None:
+            return etag
+
+        # A replica may not have the latest revision yet
+        with primary_reads():
+            epoch, value = db.session.execute(
+                select([stored_revision.c.epoch,
+                        stored_revision.c.value])).first()
+        etag = f'{epoch}-{value}'
+        with self._lock:
+            if changes == self._changes:
+                self._etag = etag
+        return etag
+
+
+bank_revision = BankRevision()
+
+
+@on_change
+def bump_bank_revision(table, action, record, previous):
+    bank_revision.bump()
+
+
+@on_change
+def hold_reads_on_primary(table, action, record, previous):
+    note_change()
+
 
-db = SQLAlchemy()
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. The database URI is
+    database_path, else the app's SQLALCHEMY_DATABASE_URI, else the
+    TRIVIA_DATABASE_URL environment variable, else the local trivia database.
+    Engine tuning comes from engine_config (see engine_config.py), else the
+    app config, else the environment, and so do the read replicas (see
+    read_replicas.py). No connection is made until the first
+    query, the schema is created and upgraded by init_db().
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None, engine_config=None):
+    if database_path is None:
+        database_path = (app.config.get("SQLALCHEMY_DATABASE_URI")
+                         or os.environ.get("TRIVIA_DATABASE_URL",
+                                           DEFAULT_DATABASE_PATH))
+    if engine_config is None:
+        engine_config = app.config
+
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    engine_config = load_engine_config(engine_config)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path,
+                                                             engine_config)
+    configure_replicas(app, engine_config)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    notify_change(None, 'reset')
+
+
+'''
+init_db(app)
+    applies the schema migrations the app's database has not seen yet and
+    returns their versions. Run through `flask init-db` before serving,
+    outside the request path.
+'''
+
+
+def init_db(app):
+    with app.app_context():
+        applied = upgrade(db.engine, db.metadata)
+    notify_change(None, 'reset')
+    return applied
 
 
 '''
@@ -29,13 +242,22 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_difficulty', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer,
+                      ForeignKey('categories.id',
+                                 onupdate='CASCADE',
+                                 ondelete='SET NULL'))
     difficulty = Column(Integer)
 
+    FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
     def __init__(self, question, answer, category, difficulty):
         self.question = question
         self.answer = answer
@@ -44,14 +266,86 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_change('questions', 'insert', self._inserted_record)
+
+    def _inserted_record(self):
+        record = self._committed_record = self.format()
+        return record
+
+    @classmethod
+    def insert_many(cls, questions):
+        '''Inserts questions, given as dicts of their column values, with one
+        multi-row INSERT ... RETURNING statement, committed with the open unit
+        of work if any. Databases without RETURNING get an INSERT per question.
+
+        Returns:
+            The ids of the new questions, in the order of questions.
+        '''
+        records = [{key: values.get(key)
+                    for key in ('question', 'answer', 'category', 'difficulty')}
+                   for values in questions]
+        if not records:
+            return []
+
+        with unit_of_work():
+            connection = db.session.connection()
+            if connection.dialect.implicit_returning:
+                # Ids are drawn from the sequence in the order of the VALUES
+                ids = sorted(row[0] for row in db.session.execute(
+                    cls.__table__.insert().values(records).returning(cls.id)))
+            else:
+                ids = [db.session.execute(
+                    cls.__table__.insert().values(record)
+                ).inserted_primary_key[0] for record in records]
+            for question_id, record in zip(ids, records):
+                commit_change('questions', 'insert',
+                              {'id': question_id, **record})
+
+        return ids
 
     def update(self):
-        db.session.commit()
+        record = self.format()
+        # Attribute history is gone once an autoflush has run, the values
+        # last loaded or notified are kept instead
+        previous = dict(record, **getattr(self, '_committed_record', {}))
+        commit_change('questions', 'update', record, previous)
+        self._committed_record = record
 
     def delete(self):
+        record = self.format()
         db.session.delete(self)
-        db.session.commit()
+        commit_change('questions', 'delete', record)
+
+    @classmethod
+    def delete_many(cls, question_ids):
+        '''Deletes the questions with question_ids using one SELECT and one
+        DELETE statement, committed with the open unit of work if any.
+
+        Returns:
+            The sorted ids of the questions that existed and were deleted.
+        '''
+        question_ids = sorted(set(question_ids))
+        if not question_ids:
+            return []
+
+        with unit_of_work():
+            selection = cls.query.filter(cls.id.in_(question_ids))
+            records = [
+                cls.format(row) for row in selection.with_entities(
+                    cls.id, cls.question, cls.answer, cls.category,
+                    cls.difficulty).order_by(cls.id)
+            ]
+            if records:
+                selection.delete(synchronize_session=False)
+            for record in records:
+                # Objects loaded earlier would otherwise be flushed again
+                loaded = db.session.identity_map.get(
+                    identity_key(cls, record['id']))
+                if loaded is not None:
+                    db.session.expunge(loaded)
+                commit_change('questions', 'delete', record)
+
+        return [record['id'] for record in records]
 
     def format(self):
         return {
@@ -63,6 +357,17 @@ class Question(db.Model):
         }
 
 
+@event.listens_for(Question, 'load')
+@event.listens_for(Question, 'refresh')
+def remember_committed_record(question, context, attrs=None):
+    state = inspect(question)
+    # Attributes changed since the load keep the value they were loaded with
+    question._committed_record = dict(
+        getattr(question, '_committed_record', {}),
+        **{key: state.dict[key] for key in attrs or Question.FIELDS
+           if key in state.dict and key not in state.committed_state})
+
+
 '''
 Category
 
@@ -78,5 +383,64 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        commit_change('categories', 'insert', self.format)
+
+    def update(self):
+        commit_change('categories', 'update', self.format())
+
+    def delete(self):
+        record = self.format()
+        db.session.delete(self)
+        commit_change('categories', 'delete', record)
+
     def format(self):
         return {'id': self.id, 'type': self.type}
+
+
+'''
+CategoryCache
+    keeps the {id: type} map of all categories and its JSON encoding in memory
+    so routes do not query categories on every request
+'''
+
+
+class CategoryCache:
+    def __init__(self, ttl=CATEGORY_CACHE_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entry = None
+
+    def _load(self):
+        with self._lock:
+            if self._entry is None or self._entry[0] <= self._clock():
+                categories = {
+                    category.id: category.type
+                    for category in Category.query.order_by(Category.id)
+                }
+                self._entry = (self._clock() + self.ttl, categories,
+                               json.dumps(categories).encode('utf-8'))
+            return self._entry
+
+    def get(self):
+        '''Returns the {id: type} map of all categories, which must not be mutated'''
+        return self._load()[1]
+
+    def get_json(self):
+        '''Returns get() encoded as JSON bytes'''
+        return self._load()[2]
+
+    def invalidate(self):
+        with self._lock:
+            self._entry = None
+
+
+categories_cache = CategoryCache()
+
+
+@on_change
+def invalidate_categories_cache(table, action, record, previous):
+    if table in (None, 'categories'):
+        categories_cache.invalidate()
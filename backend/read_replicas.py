@@ -0,0 +1,252 @@
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.selectable import SelectBase
+
+'''
+read_replicas
+    routes the reads of GET requests and quiz draws to read replicas of the
+    primary database, round-robin over the replicas that pass their health
+    checks. Writes, reads made after a write in the same request and reads
+    of clients that wrote recently stay on the primary.
+
+    Replicas are listed by the DB_REPLICAS setting and registered as the
+    replica_0 ... replica_N binds of the app.
+'''
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND_PREFIX = 'replica_'
+# Set on responses to writes, its requests read from the primary until it expires
+PRIMARY_COOKIE = 'trivia_read_primary'
+
+_last_change = float('-inf')
+
+
+def note_change():
+    ''' Records that the bank changed, replicas may not have caught up yet '''
+    global _last_change
+    _last_change = time.monotonic()
+
+
+def replica_urls(setting):
+    ''' Returns the replica database URLs of a DB_REPLICAS setting, a list or
+    a comma separated string
+    '''
+    if isinstance(setting, str):
+        setting = setting.split(',')
+    return [url.strip() for url in setting or () if url.strip()]
+
+
+class ReplicaSet:
+    ''' The replica binds of an app with their health.
+
+    choose() hands the binds out round-robin, skipping the ones found down. A
+    replica is checked with a SELECT 1 the first time it is chosen and again
+    once check_interval seconds have passed since, so a replica marked down
+    rejoins after its next successful check.
+    '''
+
+    def __init__(self, keys, check_interval, max_lag, clock=time.monotonic):
+        self.keys = tuple(keys)
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self._checked = {}
+        self._down = set()
+        self._watched = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def lagging(self):
+        ''' True while the replicas may still miss the latest change '''
+        return self._clock() - _last_change < self.max_lag
+
+    def watch(self, key, engine):
+        ''' Marks key down when engine loses its connection to the database '''
+        with self._lock:
+            if key in self._watched:
+                return
+            self._watched.add(key)
+
+        @event.listens_for(engine, 'handle_error')
+        def mark_down(context):
+            if context.is_disconnect:
+                self.mark_down(key)
+
+    def mark_down(self, key):
+        with self._lock:
+            self._down.add(key)
+            self._checked[key] = self._clock()
+
+    def healthy(self, key, probe):
+        ''' Returns whether key is up, calling probe(key) when it is due a
+        check
+        '''
+        now = self._clock()
+        with self._lock:
+            last = self._checked.get(key)
+            due = last is None or now - last >= self.check_interval
+            if due:
+                self._checked[key] = now
+        if not due:
+            return key not in self._down
+
+        try:
+            probe(key)
+        except Exception:
+            logger.warning('Read replica %s is down', key, exc_info=True)
+            self.mark_down(key)
+            return False
+        with self._lock:
+            self._down.discard(key)
+        return True
+
+    def choose(self, probe):
+        ''' Returns the next healthy replica bind key, or None if all are
+        down
+        '''
+        for _ in range(len(self.keys)):
+            with self._lock:
+                key = self.keys[next(self._turn) % len(self.keys)]
+            if self.healthy(key, probe):
+                return key
+        return None
+
+
+def configure_replicas(app, config):
+    ''' Registers the replicas of config['DB_REPLICAS'] as binds of app.
+
+    Replicas share the engine settings of the primary, so they must run the
+    same database backend.
+    '''
+    urls = replica_urls(config['DB_REPLICAS'])
+    primary = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    for url in urls:
+        if make_url(url).get_backend_name() != primary.get_backend_name():
+            raise ValueError(
+                f'Replica {url} does not run the backend of the primary')
+
+    keys = [f'{REPLICA_BIND_PREFIX}{number}' for number in range(len(urls))]
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds.update(zip(keys, urls))
+    app.config['SQLALCHEMY_BINDS'] = binds or None
+    app.extensions['read_replicas'] = ReplicaSet(
+        keys, config['DB_REPLICA_CHECK_INTERVAL'], config['DB_REPLICA_LAG'])
+
+
+def replica_set(app):
+    return app.extensions.get('read_replicas')
+
+
+def replica_reads(view):
+    ''' Lets the reads of view go to a replica.
+
+    They stay on the primary when the client sends the PRIMARY_COOKIE of a
+    recent write, and while a change is younger than DB_REPLICA_LAG seconds,
+    so caches filled by the request never hold what a replica has not caught
+    up with.
+    '''
+    @wraps(view)
+    def routed_view(*args, **kwargs):
+        replicas = replica_set(current_app)
+        g.read_from_replica = bool(replicas) and \
+            PRIMARY_COOKIE not in request.cookies and not replicas.lagging
+        return view(*args, **kwargs)
+
+    return routed_view
+
+
+def reading_from_replica():
+    ''' Returns whether the reads of the current request go to a replica '''
+    return has_request_context() and bool(g.get('read_from_replica'))
+
+
+@contextmanager
+def primary_reads():
+    ''' Sends the reads made within the block to the primary, for those that
+    must not miss a change a replica may not have caught up with
+    '''
+    routed = g.get('read_from_replica')
+    g.read_from_replica = False
+    try:
+        yield
+    finally:
+        g.read_from_replica = routed
+
+
+def route_reads(app):
+    ''' Sends clients that wrote through app a PRIMARY_COOKIE, so their reads
+    see their writes for the next DB_REPLICA_LAG seconds
+    '''
+    @app.after_request
+    def read_your_writes(response):
+        replicas = replica_set(app)
+        if replicas and g.get('wrote_to_primary') and replicas.max_lag > 0:
+            response.set_cookie(PRIMARY_COOKIE, '1', max_age=replicas.max_lag,
+                                httponly=True, samesite='Lax')
+        return response
+
+
+class RoutingSession(SignallingSession):
+    ''' Session sending the plain SELECTs of replica_reads() views to a
+    replica, and everything else to the primary
+    '''
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context():
+            # Pending changes were flushed, through this method, before the
+            # query runs
+            if isinstance(clause, SelectBase) and \
+                    getattr(clause, '_for_update_arg', None) is None:
+                engine = self._replica_engine()
+                if engine is not None:
+                    return engine
+            else:
+                g.wrote_to_primary = True
+        return super().get_bind(mapper, clause)
+
+    def _replica_engine(self):
+        if not g.get('read_from_replica') or g.get('wrote_to_primary'):
+            return None
+        replicas = replica_set(self.app)
+        key = g.get('replica_bind')
+        if key is None:
+            key = replicas.choose(self._probe)
+            if key is None:
+                g.read_from_replica = False
+                return None
+            # Every read of the request goes to the same replica
+            g.replica_bind = key
+        return self._replica(replicas, key)
+
+    def _replica(self, replicas, key):
+        engine = self.db.get_engine(self.app, bind=key)
+        replicas.watch(key, engine)
+        return engine
+
+    def _probe(self, key):
+        replicas = replica_set(self.app)
+        with self._replica(replicas, key).connect() as connection:
+            connection.execute(text('SELECT 1'))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -1,32 +1,454 @@
+import asyncio
+import gzip
+import io
 import os
+import pickle
+import random
+import re
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import sys
+import tempfile
+import threading
+from array import array
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.pool import Pool
+from flask import Response, g
+from werkzeug.http import parse_accept_header
+from werkzeug.test import EnvironBuilder
+
+import benchmark
+import change_feed
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.asgi import AsgiApp, build_environ
+from flaskr.response_cache import (LRUResponseCache, ResponseCacheBackend,
+                                   page_cache)
+from flaskr import compression, serialization
+from flaskr.filters import QuestionFilter
+from flaskr.search import InvertedIndex
+from flaskr.snapshot import QuestionSnapshot, question_snapshot
+from flaskr.quiz import (QuestionIndex, QuizSession, draw_questions,
+                         question_index)
+from flaskr.store import TTLStore
+from engine_config import load_engine_config, pool_stats
+from migrations import MIGRATIONS, applied_versions, upgrade
+from read_replicas import PRIMARY_COOKIE
+from models import (BankRevision, db, init_db, notify_change, on_change,
+                    unit_of_work, change_listeners, Question, Category)
+
+# The tests run in a single process, those of the change feed attach their own
+os.environ.setdefault('TRIVIA_CHANGE_FEED', 'none')
+
+
+class FakeSharedResponseCache(ResponseCacheBackend):
+    """Stands in for a shared response cache, recording what it is asked"""
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, body, scope):
+        self.entries[key] = (body, scope)
+
+    def evict_scope(self, scope):
+        self.entries = {
+            key: entry
+            for key, entry in self.entries.items() if entry[1] != scope
+        }
+
+    def clear(self):
+        self.entries = {}
+
+
+def asgi_request(app, method, path, query_string=b'', body=b'', headers=()):
+    """Sends one request through an ASGI app, returns (status, headers, body)"""
+    status, header_list, data = asgi_exchange(app, method, path, query_string,
+                                              body, headers)
+    return status, dict(header_list), data
+
+
+def asgi_exchange(app, method, path, query_string=b'', body=b'', headers=()):
+    """Sends one request through an ASGI app, returns (status, header list,
+    body)"""
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': query_string,
+        'headers': [(name.encode(), value.encode()) for name, value in headers],
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 5000),
+    }
+    # Bodies arrive in two chunks to exercise more_body
+    incoming = [
+        {'type': 'http.request', 'body': body[:4], 'more_body': True},
+        {'type': 'http.request', 'body': body[4:], 'more_body': False},
+    ]
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start = sent[0]
+    response_headers = [(name.decode(), value.decode())
+                        for name, value in start['headers']]
+    data = b''.join(message.get('body', b'') for message in sent[1:])
+    return start['status'], response_headers, data
+
+
+class AsgiClient:
+    """Stands in for the Flask test client, sending each request through an
+    AsgiApp instead of calling the WSGI app
+    """
+    def __init__(self, asgi_app):
+        self.asgi_app = asgi_app
+
+    def open(self, path, method='GET', **kwargs):
+        environ = EnvironBuilder(path=path, method=method,
+                                 **kwargs).get_environ()
+        headers = [
+            (key[5:].replace('_', '-').title(), value)
+            for key, value in environ.items() if key.startswith('HTTP_') and
+            key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH')
+        ] + [
+            (key.replace('_', '-').title(), environ[key])
+            for key in ('CONTENT_TYPE', 'CONTENT_LENGTH') if environ.get(key)
+        ]
+        status, response_headers, data = asgi_exchange(
+            self.asgi_app, method,
+            environ['PATH_INFO'].encode('latin-1').decode('utf-8'),
+            query_string=environ['QUERY_STRING'].encode('latin-1'),
+            body=environ['wsgi.input'].read(), headers=headers)
+        return Response(data, status=status, headers=response_headers)
+
+    def get(self, path, **kwargs):
+        return self.open(path, 'GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, 'POST', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, 'DELETE', **kwargs)
+
+
+class CopyingStore(TTLStore):
+    """Stands in for a shared session store, which hands out copies of what
+    it was given"""
+    def get(self, key, default=None):
+        value = super().get(key)
+        return default if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        super().set(key, pickle.dumps(value))
+
+    def pop(self, key, default=None):
+        value = super().pop(key)
+        return default if value is None else pickle.loads(value)
+
+
+class SavepointSession(scoped_session):
+    """Rolls a session back to its savepoint when it is removed, closing a
+    session would leave the SAVEPOINT open on the shared connection
+    """
+    def remove(self):
+        if self.registry.has():
+            session = self.registry()
+            session.info['removing'] = True
+            session.rollback()
+        super().remove()
+
+
+def rolled_back_session(connection):
+    """Returns a scoped session running the queries of every app on the
+    database of connection in SAVEPOINTs on it, so commits and rollbacks stay
+    inside its transaction. Apps on other databases, e.g. the benchmark's,
+    get sessions of their own engine as usual.
+    """
+    bound = db.create_session({'bind': connection, 'binds': {}})
+    unbound = db.create_session({})
+
+    @event.listens_for(bound, 'after_transaction_end')
+    def restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested and \
+                not session.info.get('removing'):
+            session.expire_all()
+            session.begin_nested()
+
+    def on_connection():
+        return db.get_engine(db.get_app()).url == connection.engine.url
+
+    def create_session():
+        if not on_connection():
+            return unbound()
+        session = bound()
+        session.begin_nested()
+        return session
+
+    def scope():
+        # Every request thread on the connection, e.g. ASGI workers, shares
+        # one session, requests of a test run one at a time
+        if on_connection():
+            return None
+        return id(db.get_app()), threading.get_ident()
+
+    return SavepointSession(create_session, scopefunc=scope)
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
+    @classmethod
+    def setUpClass(cls):
+        """Create the app once and bring the test database schema up to date"""
+        cls.database_name = "trivia"
+        cls.database_path = "postgresql:///{}".format(cls.database_name)
+        cls.app = create_app({'SQLALCHEMY_DATABASE_URI': cls.database_path})
+        init_db(cls.app)
+
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Run each test in a transaction, rolled back in tearDown."""
         self.client = self.app.test_client
-        self.database_name = "trivia"
-        self.database_path = "postgresql:///{}".format(self.database_name)
-        setup_db(self.app, self.database_path)
+        self.context = self.app.app_context()
+        self.context.push()
+        page_cache.backend = self.app.config['RESPONSE_CACHE']
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.session
+        db.session = rolled_back_session(self.connection)
 
     def tearDown(self):
-        """Executed after reach test"""
-        pass
+        """Roll back the test's writes and drop what was derived from them."""
+        db.session.remove()
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
+        self.context.pop()
+        notify_change(None, 'reset')
+
+    def test_schema_is_migrated(self):
+        self.assertEqual(upgrade(db.engine, db.metadata), [])
+        self.assertEqual(applied_versions(db.engine),
+                         {version for version, _, _ in MIGRATIONS})
+
+        response = self.client().get('/api/v1/categories/1/questions')
+        data = json.loads(response.data)
+        for question in data['questions']:
+            self.assertEqual(question['category'], 1)
+
+    def test_init_db_command(self):
+        result = self.app.test_cli_runner().invoke(args=['init-db'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Schema is up to date', result.output)
+
+    def test_create_app_does_no_io(self):
+        connections = []
+        listener = lambda *args: connections.append(args)
+        event.listen(Pool, 'connect', listener)
+        try:
+            create_app({'SQLALCHEMY_DATABASE_URI':
+                        'postgresql:///trivia_not_created'})
+        finally:
+            event.remove(Pool, 'connect', listener)
+
+        self.assertEqual(connections, [])
+
+    def explain(self, statement):
+        with db.engine.begin() as connection:
+            connection.execute('SET LOCAL enable_seqscan = off')
+            return '\n'.join(
+                row[0] for row in connection.execute('EXPLAIN ' + statement))
+
+    def test_category_queries_use_category_id_index(self):
+        plan = self.explain(
+            'SELECT id FROM questions WHERE category = 1 ORDER BY id LIMIT 10')
+
+        self.assertIn('ix_questions_category_id', plan)
+        self.assertNotIn('Sort', plan)
+
+    def test_difficulty_queries_use_difficulty_index(self):
+        plan = self.explain(
+            'SELECT id FROM questions WHERE difficulty BETWEEN 3 AND 5')
+
+        self.assertIn('ix_questions_difficulty', plan)
+
+    def test_engine_config_from_test_config(self):
+        app = create_app({'DB_POOL_SIZE': 2, 'DB_STATEMENT_TIMEOUT': 1500})
+        app.test_client().get('/api/v1/categories/1/questions')
+
+        with app.app_context():
+            engine = db.get_engine(app)
+            timeout = engine.execute('SHOW statement_timeout').scalar()
+            stats = pool_stats(engine)
+
+        self.assertEqual(engine.pool.size(), 2)
+        self.assertEqual(timeout, '1500ms')
+        self.assertGreater(stats['checkouts'], 0)
+        self.assertEqual(sum(stats['buckets'].values()), stats['checkouts'])
+
+    def test_engine_config_from_environment(self):
+        config = load_engine_config(
+            {'DB_MAX_OVERFLOW': 3},
+            environ={'TRIVIA_DB_POOL_SIZE': '7',
+                     'TRIVIA_DB_MAX_OVERFLOW': '9',
+                     'TRIVIA_DB_POOL_PRE_PING': 'false'})
+
+        self.assertEqual(config['DB_POOL_SIZE'], 7)
+        self.assertEqual(config['DB_MAX_OVERFLOW'], 3)
+        self.assertIs(config['DB_POOL_PRE_PING'], False)
+        self.assertEqual(config['DB_EXECUTEMANY_MODE'], 'values')
+
+    def test_reads_routed_to_replicas(self):
+        with tempfile.TemporaryDirectory() as directory:
+            urls = {}
+            for name in ('primary', 'replica a', 'replica b'):
+                urls[name] = 'sqlite:///' + os.path.join(directory,
+                                                         name + '.db')
+                app = create_app({'SQLALCHEMY_DATABASE_URI': urls[name]})
+                init_db(app)
+                with app.app_context():
+                    db.engine.execute(Question.__table__.insert().values(
+                        question=name, answer='Yes', category=1,
+                        difficulty=1))
+            missing = 'sqlite:///' + os.path.join(directory, 'gone', 'x.db')
+
+            def read(client):
+                data = json.loads(
+                    client.get('/api/v1/questions?limit=10').data)
+                return [question['question'] for question in data['questions']]
+
+            app = create_app({'SQLALCHEMY_DATABASE_URI': urls['primary'],
+                              'DB_REPLICAS': [urls['replica a'], missing,
+                                              urls['replica b']],
+                              'DB_REPLICA_LAG': 0,
+                              'QUESTION_SNAPSHOT': False})
+            client = app.test_client()
+            # Round-robin, passing over the replica that fails its check
+            self.assertEqual([read(client) for _ in range(3)],
+                             [['replica a'], ['replica b'], ['replica a']])
+
+            client.set_cookie('localhost', PRIMARY_COOKIE, '1')
+            self.assertEqual(read(client), ['primary'])
+
+            # Within DB_REPLICA_LAG seconds of a change reads stay on the
+            # primary, and writers are told to keep reading from it
+            app = create_app({'SQLALCHEMY_DATABASE_URI': urls['primary'],
+                              'DB_REPLICAS': urls['replica a'],
+                              'DB_REPLICA_LAG': 60,
+                              'QUESTION_SNAPSHOT': False})
+            client = app.test_client()
+            response = client.post('/api/v1/questions', json={
+                'question': 'written', 'answer': 'Yes', 'category': 1,
+                'difficulty': 1})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(PRIMARY_COOKIE, response.headers['Set-Cookie'])
+            client.cookie_jar.clear()
+            self.assertEqual(read(client), ['primary', 'written'])
+
+    def test_quiz_draw_rechecks_replica_misses_on_primary(self):
+        with tempfile.TemporaryDirectory() as directory:
+            urls = {}
+            for name, count in (('primary', 2), ('replica', 1)):
+                urls[name] = 'sqlite:///' + os.path.join(directory,
+                                                         name + '.db')
+                app = create_app({'SQLALCHEMY_DATABASE_URI': urls[name]})
+                init_db(app)
+                with app.app_context():
+                    for _ in range(count):
+                        db.engine.execute(Question.__table__.insert().values(
+                            question=name, answer='Yes', category=1,
+                            difficulty=1))
+
+            app = create_app({'SQLALCHEMY_DATABASE_URI': urls['primary'],
+                              'DB_REPLICAS': urls['replica'],
+                              'DB_REPLICA_LAG': 0,
+                              'QUESTION_SNAPSHOT': False})
+            # Question 2 is not on the replica yet, question 3 is gone
+            index = QuestionIndex()
+            index._all_ids = array('l', [1, 2, 3])
+            index._buckets = {(1, 1): array('l', [1, 2, 3])}
+            with app.test_request_context('/api/v1/quizzes'):
+                g.read_from_replica = True
+                questions, remaining = draw_questions(
+                    QuestionFilter(), [], count=3, index=index)
+
+        self.assertEqual(sorted((question['id'], question['question'])
+                                for question in questions),
+                         [(1, 'replica'), (2, 'primary')])
+        self.assertEqual(remaining, 0)
+        self.assertEqual(list(index.eligible(QuestionFilter())), [1, 2])
+
+    def test_benchmark_runs_every_scenario(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = benchmark.generate_bank(
+                'sqlite:///' + os.path.join(directory, 'bench.db'),
+                questions=200, categories=4, skew=1.0)
+            results = benchmark.run(app, 200, 4, modes=('client',),
+                                    requests=5)
+            startup = benchmark.measure_startup(
+                'sqlite:///' + os.path.join(directory, 'bench.db'), runs=1)
+
+        self.assertEqual(startup['startup_connections'], 0)
+        self.assertEqual(startup['errors'], 0)
+
+        self.assertEqual(len(results), len(benchmark.scenarios(app, 200, 4)))
+        for key, result in results.items():
+            self.assertEqual(result['errors'], 0, key)
+            self.assertIn('alloc_kib', result)
+        self.assertEqual(results['export/client/c1']['rows'], 200)
+        # Each delete scenario finds questions of its own to delete
+        self.assertGreater(results['delete_question/client/c1']['rows'], 0)
+        self.assertGreater(
+            results['bulk_delete_questions/client/c1']['rows'], 0)
+        self.assertEqual(results['export/client/c1']['queries'], 1)
+
+        regressed = dict(results['export/client/c1'])
+        regressed['queries'] += 1
+        self.assertEqual(
+            benchmark.compare({'export/client/c1': regressed}, results),
+            ['export/client/c1 queries 1.0 -> 2.0'])
+        self.assertEqual(benchmark.compare(results, results), [])
+
+    def test_request_instrumentation(self):
+        app = create_app({'SLOW_QUERY_MS': 0.000001, 'N_PLUS_ONE_THRESHOLD': 2})
+        client = app.test_client()
+
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            response = client.get('/api/v1/questions?limit=5')
+        timing = response.headers['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[0-9.]+;desc="[0-9]+ queries", '
+                                 r'serialize;dur=[0-9.]+, total;dur=[0-9.]+$')
+        self.assertTrue(any('Slow query' in line for line in logs.output))
+
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            with app.test_request_context('/'):
+                app.preprocess_request()
+                Question.query.get(1)
+                Question.query.get(2)
+                app.process_response(app.response_class())
+        self.assertTrue(any('likely N+1' in line for line in logs.output))
+
+        body = client.get('/metrics').data.decode()
+        self.assertIn('trivia_request_duration_seconds_count{method="GET",'
+                      'route="get_questions",status="200"}', body)
+        self.assertIn('trivia_request_queries_bucket{method="GET",'
+                      'route="get_questions",status="200",le="1"}', body)
+        self.assertIn('trivia_db_pool_wait_seconds_count', body)
 
     def test_get_all_categories(self):
         response = self.client().get('/api/v1/categories')
@@ -36,6 +458,22 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['categories'], True)
 
+    def test_get_categories_refreshes_after_category_write(self):
+        before = json.loads(
+            self.client().get('/api/v1/categories').data)['categories']
+
+        category = Category(type='Music')
+        category.insert()
+        added = json.loads(
+            self.client().get('/api/v1/categories').data)['categories']
+        category.delete()
+        after = json.loads(
+            self.client().get('/api/v1/categories').data)['categories']
+
+        self.assertEqual(added[str(category.id)], 'Music')
+        self.assertEqual(len(added), len(before) + 1)
+        self.assertEqual(after, before)
+
     def test_get_paginated_questions(self):
         response = self.client().get('/api/v1/questions')
         data = json.loads(response.data)
@@ -46,6 +484,345 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
         self.assertTrue(len(data['categories']))
 
+    def test_get_questions_filtered(self):
+        matching = [
+            question.id
+            for question in Question.query.filter(
+                Question.category.in_([1, 4]),
+                Question.difficulty.between(2, 4)).order_by(Question.id)
+        ]
+        query = '?categories=1,4&min_difficulty=2&max_difficulty=4'
+        data = json.loads(self.client().get('/api/v1/questions' + query).data)
+        self.assertEqual(data['total_questions'], len(matching))
+        self.assertEqual([question['id'] for question in data['questions']],
+                         matching[:10])
+
+        cursor_ids = []
+        after = ''
+        while after is not None:
+            data = json.loads(self.client().get(
+                '/api/v1/questions' + query + f'&limit=2&after={after}').data)
+            cursor_ids.extend(question['id'] for question in data['questions'])
+            after = data['next_cursor']
+        self.assertEqual(cursor_ids, matching)
+
+        data = json.loads(self.client().get(
+            '/api/v1/categories/4/questions?max_difficulty=1').data)
+        self.assertEqual(data['total_questions'], len([
+            question for question in Question.query.filter_by(category=4)
+            if question.difficulty <= 1
+        ]))
+        for question in data['questions']:
+            self.assertEqual(question['category'], 4)
+            self.assertLessEqual(question['difficulty'], 1)
+
+        response = self.client().get('/api/v1/questions?min_difficulty=9')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_paginated_questions_second_page(self):
+        first_page = json.loads(
+            self.client().get('/api/v1/questions').data)
+        response = self.client().get('/api/v1/questions?page=2')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['current_page'], 2)
+        self.assertEqual(data['total_questions'],
+                         first_page['total_questions'])
+        self.assertEqual(len(data['questions']),
+                         min(10, data['total_questions'] - 10))
+        self.assertGreater(data['questions'][0]['id'],
+                           first_page['questions'][-1]['id'])
+
+    def test_get_questions_with_cursor(self):
+        total = json.loads(
+            self.client().get('/api/v1/questions').data)['total_questions']
+
+        seen_ids = []
+        url = '/api/v1/questions?limit=4'
+        while url:
+            response = self.client().get(url)
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['limit'], 4)
+            self.assertNotIn('current_page', data)
+            seen_ids.extend(question['id'] for question in data['questions'])
+            url = (f'/api/v1/questions?limit=4&after={data["next_cursor"]}'
+                   if data['next_cursor'] else None)
+
+        self.assertEqual(len(seen_ids), total)
+        self.assertEqual(seen_ids, sorted(set(seen_ids)))
+
+    def test_get_questions_with_invalid_cursor(self):
+        response = self.client().get('/api/v1/questions?after=not-a-cursor')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_questions_conditional_request(self):
+        response = self.client().get('/api/v1/questions')
+        etag = response.headers['ETag']
+
+        not_modified = self.client().get(
+            '/api/v1/questions', headers={'If-None-Match': etag})
+
+        Question(question='Revision bump', answer='Yes', category=1,
+                 difficulty=1).insert()
+        modified = self.client().get('/api/v1/questions',
+                                     headers={'If-None-Match': etag})
+        Question.query.filter_by(question='Revision bump').one().delete()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Cache-Control', response.headers)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.data, b'')
+        self.assertEqual(not_modified.headers['ETag'], etag)
+        self.assertEqual(modified.status_code, 200)
+        self.assertNotEqual(modified.headers['ETag'], etag)
+
+    def test_get_questions_with_fields(self):
+        statements = []
+        listener = lambda conn, cursor, statement, *args: \
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.client().get(
+                '/api/v1/questions?fields=question,category')
+            cursor_response = self.client().get(
+                '/api/v1/categories/1/questions?limit=2&fields=question')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        data = json.loads(response.data)
+        cursor_data = json.loads(cursor_response.data)
+
+        self.assertEqual(response.status_code, 200)
+        for question in data['questions']:
+            self.assertEqual(set(question), {'id', 'question', 'category'})
+        for question in cursor_data['questions']:
+            self.assertEqual(set(question), {'id', 'question'})
+        self.assertIsNotNone(cursor_data['next_cursor'])
+        if not question_snapshot.loaded:
+            self.assertFalse(any('questions.answer' in statement
+                                 for statement in statements))
+
+        response = self.client().get('/api/v1/questions?fields=secret')
+        self.assertEqual(response.status_code, 400)
+
+    def test_responses_compressed_when_accepted(self):
+        response = self.client().get('/api/v1/questions',
+                                     headers={'Accept-Encoding': 'gzip'})
+        plain = self.client().get('/api/v1/questions')
+        small = self.client().get('/api/v1/categories',
+                                  headers={'Accept-Encoding': 'gzip'})
+        not_modified = self.client().get(
+            '/api/v1/questions', headers={'Accept-Encoding': 'gzip',
+                                          'If-None-Match': response.headers['ETag']})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertEqual(response.headers['ETag'],
+                         plain.headers['ETag'][:-1] + '-gzip"')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertNotIn('Content-Encoding', small.headers)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.headers['ETag'],
+                         response.headers['ETag'])
+
+        self.assertIsNone(compression.negotiate(
+            parse_accept_header('gzip;q=0, br;q=0, *')))
+        self.assertEqual(compression.negotiate(parse_accept_header('*')),
+                         compression.ENCODINGS[0])
+
+    def test_question_pages_served_from_response_cache(self):
+        cache = FakeSharedResponseCache()
+        client = create_app({'RESPONSE_CACHE': cache}).test_client()
+
+        first = client.get('/api/v1/categories/2/questions')
+        second = client.get('/api/v1/categories/2/questions')
+        client.get('/api/v1/questions')
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(
+            sorted(scope for _, scope in cache.entries.values()),
+            ['all', 'category:2'])
+
+        question = Question(question='Cache eviction', answer='Yes',
+                            category=3, difficulty=1)
+        question.insert()
+        self.assertEqual(
+            [scope for _, scope in cache.entries.values()], ['category:2'])
+
+        question.category = 2
+        question.update()
+        self.assertEqual(cache.entries, {})
+
+        question_id = question.id
+        response = client.get('/api/v1/categories/2/questions')
+        Question.query.get(question_id).delete()
+        self.assertIn(b'Cache eviction', response.data)
+
+    def test_serialization_falls_back_to_stdlib(self):
+        payload = {'categories': {1: 'Science'}, 'question': 'Caf\u00e9?'}
+        with self.app.app_context():
+            rows = serialization.question_rows(
+                Question.query.order_by(Question.id)).limit(3).all()
+            formatted = [question.format() for question in
+                         Question.query.order_by(Question.id).limit(3)]
+        self.assertEqual(serialization.format_rows(rows), formatted)
+
+        fast = serialization.dumps(payload)
+        fast_encoded = serialization.FastJSONEncoder().encode(payload)
+        orjson = serialization.orjson
+        serialization.orjson = None
+        try:
+            self.assertEqual(serialization.dumps(payload), fast)
+            self.assertEqual(serialization.FastJSONEncoder().encode(payload),
+                             json.dumps(payload))
+        finally:
+            serialization.orjson = orjson
+        self.assertEqual(json.loads(fast_encoded), json.loads(fast))
+
+    def test_question_snapshot_serves_reads_from_memory(self):
+        app = create_app({'QUESTION_SNAPSHOT': True})
+        client = app.test_client()
+        expected = json.loads(self.client().get(
+            '/api/v1/categories/1/questions?limit=2').data)
+        client.get('/api/v1/questions?limit=1')
+
+        statements = []
+
+        def record(connection, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            listing = client.get('/api/v1/categories/1/questions?limit=2')
+            quiz = client.post('/api/v1/quizzes', json={
+                'previous_questions': [],
+                'quiz_category': {'id': 1, 'type': 'Science'}
+            })
+            search = client.post('/api/v1/questions',
+                                 json={'searchTerm': 'title'})
+        finally:
+            with app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(statements, [])
+        self.assertEqual(json.loads(listing.data), expected)
+        self.assertEqual(json.loads(quiz.data)['question']['category'], 1)
+        for question in json.loads(search.data)['questions']:
+            self.assertIn('title', question['question'].lower())
+
+        question = Question(question='Snapshot', answer='Yes', category=1,
+                            difficulty=1)
+        with app.app_context():
+            question.insert()
+            question_id = question.id
+        self.assertEqual(question_snapshot.get(question_id),
+                         (question_id, 'Snapshot', 'Yes', 1, 1))
+        with app.app_context():
+            Question.query.get(question_id).delete()
+        self.assertTrue(question_snapshot.loaded)
+        self.assertIsNone(question_snapshot.get(question_id))
+
+    def test_question_snapshot_memory_per_question(self):
+        snapshot = QuestionSnapshot()
+        snapshot.load((question_id, f'Question {question_id}?',
+                       f'Answer {question_id}', question_id % 6 + 1,
+                       question_id % 5 + 1)
+                      for question_id in range(1, 10001))
+        text = sum(sys.getsizeof(f'Question {question_id}?') +
+                   sys.getsizeof(f'Answer {question_id}')
+                   for question_id in range(1, 10001))
+
+        # Beyond its two strings a question costs a few array slots
+        self.assertLess((snapshot.memory_usage() - text) / len(snapshot), 64)
+        self.assertEqual(snapshot.page(QuestionFilter({2}), 1, 2),
+                         (1667, [(7, 'Question 7?', 'Answer 7', 2, 3),
+                                 (13, 'Question 13?', 'Answer 13', 2, 4)]))
+        self.assertEqual(
+            [row[0] for row in snapshot.page_after(QuestionFilter(), 9998, 5)],
+            [9999, 10000])
+
+    def test_question_snapshot_rejects_out_of_range_values_whole(self):
+        snapshot = QuestionSnapshot()
+        snapshot.load([(1, 'One?', 'One', 1, 1), (2, 'Two?', 'Two', 1, 2)])
+
+        with self.assertRaises(OverflowError):
+            snapshot.put({'id': 3, 'question': 'Three?', 'answer': 'Three',
+                          'category': 1, 'difficulty': 2 ** 40})
+        # Cleared rather than left with columns of different lengths
+        self.assertFalse(snapshot.loaded)
+
+        with self.assertRaises(OverflowError):
+            snapshot.load([(1, 'One?', 'One', 1, 1),
+                           (2, 'Two?', 'Two', 2 ** 40, 2)])
+        self.assertFalse(snapshot.loaded)
+
+        snapshot.load([(1, 'One?', 'One', 1, 1000)])
+        self.assertEqual(snapshot.get(1), (1, 'One?', 'One', 1, 1000))
+
+    def test_same_seed_draws_the_same_however_buckets_were_filled(self):
+        rows = [(question_id, f'Question {question_id}?', 'Answer',
+                 question_id % 3 + 1, question_id % 4 + 1)
+                for question_id in range(1, 61)]
+        loaded, built = QuestionSnapshot(), QuestionSnapshot()
+        loaded.load(rows)
+        built.load([])
+        for question_id, question, answer, category, difficulty in \
+                reversed(rows):
+            built.put({'id': question_id, 'question': question,
+                       'answer': answer, 'category': category,
+                       'difficulty': difficulty})
+
+        loaded_index, built_index = QuestionIndex(), QuestionIndex()
+        built_index._all_ids, built_index._buckets = array('l'), {}
+        for question_id, _, _, category, difficulty in reversed(rows):
+            built_index.add(question_id, category, difficulty)
+        loaded_index._all_ids, loaded_index._buckets = array('l'), {}
+        for question_id, _, _, category, difficulty in rows:
+            loaded_index.add(question_id, category, difficulty)
+
+        for question_filter in (QuestionFilter(), QuestionFilter({3, 1}),
+                                QuestionFilter(min_difficulty=2)):
+            for first, second in ((loaded, built),
+                                  (loaded_index, built_index)):
+                draws = [
+                    [source.pick(question_filter, rng=random.Random(seed))[0]
+                     for seed in range(20)]
+                    for source in (first, second)
+                ]
+                self.assertEqual(draws[0], draws[1])
+
+    def test_create_question_with_difficulty_out_of_range(self):
+        total = Question.query.count()
+        response = self.client().post('/api/v1/questions', json={
+            'question': 'Too hard?', 'answer': 'Yes', 'category': 1,
+            'difficulty': 1000})
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Question.query.count(), total)
+        response = self.client().get('/api/v1/questions?page=2')
+        self.assertEqual(response.status_code, 200)
+
+    def test_lru_response_cache_evicts_by_size(self):
+        cache = LRUResponseCache(max_bytes=10)
+        cache.set('a', b'1234', 'all')
+        cache.set('b', b'1234', 'category:1')
+        cache.get('a')
+        cache.set('c', b'1234', 'category:1')
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.size, 8)
+        cache.evict_scope('category:1')
+        self.assertEqual((len(cache), cache.size), (1, 4))
+        cache.set('d', b'12345678901', 'all')
+        self.assertIsNone(cache.get('d'))
+
     def test_get_paginated_questions_invalid_page(self):
         response = self.client().get('/api/v1/questions?page=1000')
         data = json.loads(response.data)
@@ -56,7 +833,8 @@ class TriviaTestCase(unittest.TestCase):
 
     def test_delete_question_success(self):
         question_id = 20
-        response = self.client().delete(f'/api/v1/questions/{question_id}')
+        response = self.client().delete(
+            f'/api/v1/questions/{question_id}?include_page=true')
         data = json.loads(response.data)
 
         question = Question.query.filter_by(id=question_id).one_or_none()
@@ -67,6 +845,21 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
         self.assertEqual(question, None)
 
+    def test_delete_question_lightweight_response(self):
+        question = Question(question='Delete me', answer='Ok', category=1,
+                            difficulty=1)
+        question.insert()
+        question_id = question.id
+
+        response = self.client().delete(f'/api/v1/questions/{question_id}')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], question_id)
+        self.assertEqual(data['total_questions'], Question.query.count())
+        self.assertNotIn('questions', data)
+        self.assertIsNone(Question.query.get(question_id))
+
     def test_delete_question_not_found(self):
         question_id = 1000
         response = self.client().delete(f'/api/v1/questions/{question_id}')
@@ -76,6 +869,148 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource Not Found')
 
+    def test_delete_questions_in_bulk(self):
+        questions = [Question(question=f'Sweep {number}', answer='Ok',
+                              category=1, difficulty=1)
+                     for number in range(3)]
+        with unit_of_work():
+            for question in questions:
+                question.insert()
+        question_ids = sorted(question.id for question in questions)
+        total_questions = Question.query.count()
+
+        response = self.client().delete(
+            '/api/v1/questions?ids={},{},1000'.format(*question_ids[:2]))
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], question_ids[:2])
+        self.assertEqual(data['total_questions'], total_questions - 2)
+        self.assertEqual(
+            Question.query.filter(Question.id.in_(question_ids)).count(), 1)
+
+        response = self.client().delete('/api/v1/questions?ids=1000')
+        self.assertEqual(response.status_code, 404)
+        response = self.client().delete('/api/v1/questions?ids=1,x')
+        self.assertEqual(response.status_code, 400)
+        response = self.client().delete('/api/v1/questions')
+        self.assertEqual(response.status_code, 400)
+
+        Question.query.get(question_ids[2]).delete()
+
+    def test_update_notifies_previous_values_after_autoflush(self):
+        question = Question(question='Moving', answer='Yes', category=1,
+                            difficulty=1)
+        question.insert()
+        science, art = QuestionFilter({1}), QuestionFilter({2})
+        counts = question_index.count(science), question_index.count(art)
+
+        question.category = 2
+        Question.query.count()
+        question.update()
+
+        self.assertEqual(question_index.count(science), counts[0] - 1)
+        self.assertEqual(question_index.count(art), counts[1] + 1)
+        self.assertNotIn(question.id, question_index.eligible(science))
+
+        db.session.expunge(question)
+        question = Question.query.get(question.id)
+        question.category = 1
+        Question.query.count()
+        question.update()
+
+        self.assertEqual(question_index.count(science), counts[0])
+        self.assertEqual(question_index.count(art), counts[1])
+        question.delete()
+
+    def test_failing_change_listener_does_not_skip_the_others(self):
+        changes = []
+
+        def failing(table, action, record, previous):
+            if action != 'reset':
+                raise ValueError(action)
+
+        change_listeners.insert(0, failing)
+        listener = on_change(lambda table, action, record, previous:
+                             changes.append((table, action)))
+        try:
+            with self.assertLogs('models', 'ERROR'):
+                question = Question(question='Notified', answer='Yes',
+                                    category=1, difficulty=1)
+                question.insert()
+        finally:
+            change_listeners.remove(failing)
+            change_listeners.remove(listener)
+
+        self.assertEqual(changes, [('questions', 'insert'),
+                                   ('questions', 'reset')])
+        question.delete()
+
+    def test_unit_of_work_commits_once_and_defers_notifications(self):
+        changes = []
+        commits = []
+        listener = on_change(lambda table, action, record, previous:
+                             changes.append((table, action)))
+        counter = lambda session: commits.append(session)
+        event.listen(db.session(), 'after_commit', counter)
+        try:
+            with unit_of_work():
+                question = Question(question='Batched', answer='Ok',
+                                    category=1, difficulty=1)
+                question.insert()
+                question.difficulty = 2
+                question.update()
+                self.assertEqual(changes, [])
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(changes, [('questions', 'insert'),
+                                       ('questions', 'update')])
+
+            changes.clear()
+            with self.assertRaises(RuntimeError):
+                with unit_of_work():
+                    question.delete()
+                    raise RuntimeError
+            self.assertEqual(changes, [])
+            self.assertIsNotNone(Question.query.get(question.id))
+        finally:
+            event.remove(db.session(), 'after_commit', counter)
+            change_listeners.remove(listener)
+        question.delete()
+
+    def test_unit_of_work_batches_statements(self):
+        statements = []
+        # Leaving out the bump of the shared bank revision made by each commit
+        listener = lambda conn, cursor, statement, *args: \
+            'bank_revision' in statement or \
+            statements.append(statement.split()[0])
+        art, medium_art = QuestionFilter({2}), QuestionFilter({2}, 2, 2)
+        counts = question_index.count(art), question_index.count(medium_art)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            question_ids = Question.insert_many([
+                {'question': f'Batched {number}', 'answer': 'Ok',
+                 'category': 2, 'difficulty': 1} for number in range(3)])
+            self.assertEqual(statements.count('INSERT'), 1)
+
+            questions = Question.query.filter(
+                Question.id.in_(question_ids)).all()
+            with unit_of_work():
+                for question in questions:
+                    question.difficulty = 2
+                    question.update()
+            self.assertEqual(statements.count('UPDATE'), 1)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        self.assertEqual(len(question_ids), 3)
+        self.assertEqual(
+            [Question.query.get(question_id).question
+             for question_id in question_ids],
+            ['Batched 0', 'Batched 1', 'Batched 2'])
+        self.assertEqual(question_index.count(art), counts[0] + 3)
+        self.assertEqual(question_index.count(medium_art), counts[1] + 3)
+        Question.delete_many(question_ids)
+
     def test_create_new_question_success(self):
         payload = {
             'question': 'Who is the chicken',
@@ -93,6 +1028,9 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(question)
         self.assertEqual(payload['question'], question.question)
+        self.assertEqual(data['created'], question.id)
+        self.assertEqual(data['total_questions'], Question.query.count())
+        self.assertNotIn('questions', data)
 
     def test_create_new_question_not_allowed(self):
         payload = {
@@ -111,6 +1049,63 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(question, None)
 
+    def test_bulk_import_questions_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'question': 'Bulk NDJSON one', 'answer': 'A',
+                        'category': 1, 'difficulty': 2}),
+            '{not json',
+            json.dumps({'question': 'Bulk NDJSON two', 'answer': 'B',
+                        'category': 10000, 'difficulty': 2}),
+            json.dumps({'question': 'Bulk NDJSON three', 'answer': 'C',
+                        'category': '3', 'difficulty': '5'}),
+        ])
+        response = self.client().post('/api/v1/questions/bulk', data=body,
+                                      content_type='application/x-ndjson')
+        data = json.loads(response.data)
+
+        imported = Question.query.filter(
+            Question.question.like('Bulk NDJSON%')).all()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [2, 3])
+        self.assertEqual(sorted(question.question for question in imported),
+                         ['Bulk NDJSON one', 'Bulk NDJSON three'])
+
+        for question in imported:
+            question.delete()
+
+    def test_bulk_import_questions_csv(self):
+        body = ('question,answer,category,difficulty\n'
+                'Bulk CSV one,"Yes, really",2,1\n'
+                'Bulk CSV two,No,2,9\n')
+        response = self.client().post('/api/v1/questions/bulk', data=body,
+                                      content_type='text/csv')
+        data = json.loads(response.data)
+
+        imported = Question.query.filter(
+            Question.question.like('Bulk CSV%')).all()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'][0]['line'], 3)
+        self.assertEqual(imported[0].answer, 'Yes, really')
+
+        for question in imported:
+            question.delete()
+
+    def test_bulk_export_questions(self):
+        response = self.client().get('/api/v1/questions/export')
+        lines = response.data.decode('utf-8').splitlines()
+        exported = [json.loads(line) for line in lines]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(exported), Question.query.count())
+        self.assertEqual(set(exported[0]),
+                         {'id', 'question', 'answer', 'category', 'difficulty'})
+
     def test_search_for_questions_successful(self):
         payload = {'searchTerm': 'title'}
 
@@ -122,6 +1117,57 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(len(data['questions']))
 
+    def test_search_for_questions_by_word_prefix(self):
+        payload = {'searchTerm': 'TIT'}
+
+        response = self.client().post('/api/v1/questions', json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['total_questions'])
+        for question in data['questions']:
+            self.assertIn(' tit', ' ' + question['question'].lower())
+
+    def test_search_for_stopwords_and_underscores(self):
+        for search_term in ('the', 'a_b'):
+            response = self.client().post('/api/v1/questions',
+                                          json={'searchTerm': search_term})
+            data = json.loads(response.data)
+            if search_term == 'the':
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(data['total_questions'])
+
+            # Every word of the term starts a word of each match
+            for question in data.get('questions', []):
+                words = re.findall(r'[^\W_]+', question['question'].lower())
+                self.assertTrue(all(
+                    any(word.startswith(token) for word in words)
+                    for token in re.findall(r'[^\W_]+', search_term)))
+
+    def test_search_for_questions_not_found(self):
+        payload = {'searchTerm': 'xylophonist'}
+
+        response = self.client().post('/api/v1/questions', json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_inverted_index_search(self):
+        index = InvertedIndex()
+        index.load([(1, 'The title of the book'),
+                    (2, 'Whose title is this title?'),
+                    (3, 'Titles and titans')])
+
+        self.assertEqual(index.search('title'), [1, 2, 3])
+        self.assertEqual(index.search('tit book'), [1])
+        self.assertEqual(index.search('TITANS'), [3])
+
+        index.remove(1)
+        index.add(4, 'A book')
+        self.assertEqual(index.search('book'), [4])
+        self.assertEqual(index.search('the'), [])
+
     def test_get_question_by_category_success(self):
         category_id = 1
         response = self.client().get(
@@ -160,6 +1206,393 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['question'])
 
+    def test_start_quiz_skips_previous_questions(self):
+        category_id = 2
+        category_ids = [
+            question.id for question in Question.query.filter_by(
+                category=category_id).order_by(Question.id)
+        ]
+        payload = {
+            'previous_questions': category_ids[:-1],
+            'quiz_category': {
+                'id': str(category_id),
+                'type': 'Art'
+            }
+        }
+        response = self.client().post('/api/v1/quizzes', json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['question']['id'], category_ids[-1])
+        self.assertEqual(data['remaining_questions'], 0)
+
+    def test_start_quiz_no_questions_left(self):
+        payload = {
+            'previous_questions': [
+                question.id for question in Question.query.all()
+            ],
+            'quiz_category': {
+                'id': 0,
+                'type': 'click'
+            }
+        }
+        response = self.client().post('/api/v1/quizzes', json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_start_quiz_session(self):
+        category_ids = {
+            question.id
+            for question in Question.query.filter_by(category=2)
+        }
+        payload = {
+            'session': True,
+            'previous_questions': [],
+            'quiz_category': {
+                'id': 2,
+                'type': 'Art'
+            }
+        }
+        response = self.client().post('/api/v1/quizzes', json=payload)
+        data = json.loads(response.data)
+        quiz_id = data['quiz_id']
+
+        seen_ids = set()
+        while response.status_code == 200:
+            seen_ids.add(data['question']['id'])
+            self.assertEqual(data['quiz_id'], quiz_id)
+            self.assertEqual(data['remaining_questions'],
+                             len(category_ids) - len(seen_ids))
+            response = self.client().post('/api/v1/quizzes',
+                                          json={'quiz_id': quiz_id})
+            data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(seen_ids, category_ids)
+
+    def test_start_quiz_batch_with_seed(self):
+        total = Question.query.count()
+        payload = {
+            'previous_questions': [],
+            'quiz_category': {
+                'id': 0,
+                'type': 'click'
+            },
+            'count': 5,
+            'seed': 42
+        }
+        first = json.loads(
+            self.client().post('/api/v1/quizzes', json=payload).data)
+        second = json.loads(
+            self.client().post('/api/v1/quizzes', json=payload).data)
+
+        ids = [question['id'] for question in first['questions']]
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(first['remaining_questions'], total - 5)
+        self.assertEqual(second, first)
+
+        payload['previous_questions'] = ids
+        payload['count'] = 50
+        data = json.loads(
+            self.client().post('/api/v1/quizzes', json=payload).data)
+        self.assertEqual(len(data['questions']), total - 5)
+        self.assertFalse(set(ids) & {
+            question['id'] for question in data['questions']})
+        self.assertEqual(data['remaining_questions'], 0)
+
+        payload['count'] = 0
+        response = self.client().post('/api/v1/quizzes', json=payload)
+        self.assertEqual(response.status_code, 422)
+
+    def test_start_quiz_session_batch(self):
+        category_ids = {
+            question.id
+            for question in Question.query.filter_by(category=2)
+        }
+        payload = {
+            'session': True,
+            'previous_questions': [],
+            'quiz_category': {
+                'id': 2,
+                'type': 'Art'
+            },
+            'count': 2,
+            'seed': 7
+        }
+        data = json.loads(
+            self.client().post('/api/v1/quizzes', json=payload).data)
+        rest = json.loads(self.client().post('/api/v1/quizzes', json={
+            'quiz_id': data['quiz_id'],
+            'count': 50
+        }).data)
+
+        seen_ids = [question['id']
+                    for question in data['questions'] + rest['questions']]
+        self.assertEqual(len(data['questions']), 2)
+        self.assertEqual(data['remaining_questions'], len(category_ids) - 2)
+        self.assertEqual(sorted(seen_ids), sorted(category_ids))
+        self.assertEqual(rest['remaining_questions'], 0)
+
+    def test_start_quiz_session_in_shared_store(self):
+        category_ids = {
+            question.id
+            for question in Question.query.filter_by(category=2)
+        }
+        store = self.app.config['QUIZ_SESSION_STORE']
+        self.app.config['QUIZ_SESSION_STORE'] = CopyingStore(ttl=60)
+        try:
+            response = self.client().post('/api/v1/quizzes', json={
+                'session': True, 'previous_questions': [],
+                'quiz_category': {'id': 2, 'type': 'Art'}})
+            quiz_id = json.loads(response.data)['quiz_id']
+            seen_ids = []
+            while response.status_code == 200:
+                data = json.loads(response.data)
+                seen_ids.append(data['question']['id'])
+                self.assertEqual(data['remaining_questions'],
+                                 len(category_ids) - len(seen_ids))
+                response = self.client().post('/api/v1/quizzes',
+                                              json={'quiz_id': quiz_id})
+        finally:
+            self.app.config['QUIZ_SESSION_STORE'] = store
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(sorted(seen_ids), sorted(category_ids))
+
+    def test_quiz_session_size_does_not_grow_with_the_bank(self):
+        session = QuizSession(QuestionFilter(), seed=1)
+
+        self.assertEqual(session.remaining, Question.query.count())
+        self.assertLess(len(pickle.dumps(session)), 300)
+
+    def test_start_quiz_filtered_by_categories_and_difficulty(self):
+        matching = {
+            question.id
+            for question in Question.query.filter(
+                Question.category.in_([1, 2]), Question.difficulty >= 3)
+        }
+        payload = {
+            'previous_questions': [],
+            'categories': [1, 2],
+            'min_difficulty': 3,
+            'count': 50
+        }
+        data = json.loads(
+            self.client().post('/api/v1/quizzes', json=payload).data)
+        self.assertEqual({question['id'] for question in data['questions']},
+                         matching)
+        self.assertEqual(data['remaining_questions'], 0)
+
+        question = Question(question='Filtered', answer='Yes', category=2,
+                            difficulty=5)
+        question.insert()
+        question_id = question.id
+        payload.update({'min_difficulty': 5, 'max_difficulty': 5})
+        data = json.loads(
+            self.client().post('/api/v1/quizzes', json=payload).data)
+        Question.query.get(question_id).delete()
+        self.assertIn(question_id,
+                      [question['id'] for question in data['questions']])
+        for question in data['questions']:
+            self.assertEqual(question['difficulty'], 5)
+
+        payload.update({'min_difficulty': 4, 'max_difficulty': 2})
+        response = self.client().post('/api/v1/quizzes', json=payload)
+        self.assertEqual(response.status_code, 422)
+
+    def test_start_quiz_session_expired(self):
+        response = self.client().post('/api/v1/quizzes',
+                                      json={'quiz_id': 'no-such-quiz'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_quiz_session_store_expires_entries(self):
+        now = [0]
+        store = TTLStore(ttl=10, max_entries=2, clock=lambda: now[0])
+        store.set('a', 1)
+        now[0] = 5
+        store.set('b', 2)
+        store.set('c', 3)
+
+        self.assertIsNone(store.get('a'))
+        now[0] = 12
+        self.assertEqual(store.get('c'), 3)
+        now[0] = 16
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('c'), 3)
+        self.assertEqual(len(store), 1)
+
+    def test_change_feed_applies_writes_of_other_workers(self):
+        feed = change_feed.ChangeFeed()
+        published = []
+        feed.subscribe(published.extend)
+        change_feed.attach(feed)
+        try:
+            art = QuestionFilter({2})
+            count = question_index.count(art)
+            etag = self.client().get('/api/v1/questions').headers['ETag']
+
+            question = Question(question='Local write', answer='Yes',
+                                category=2, difficulty=1)
+            question.insert()
+            self.assertEqual(len(published), 1)
+            self.assertEqual(
+                {key: published[0][key] for key in ('table', 'action', 'id')},
+                {'table': 'questions', 'action': 'insert', 'id': question.id})
+            self.assertEqual(question_index.count(art), count + 1)
+
+            # Another worker writes a row this one was not told about
+            question_id = db.session.execute(
+                Question.__table__.insert().values(
+                    question='Remote write', answer='Yes', category=2,
+                    difficulty=1).returning(Question.id)).scalar()
+            db.session.commit()
+            # Revisions are tracked per origin for the life of the process
+            origin = f'other-worker-{id(self)}'
+            remote = {'origin': origin, 'table': 'questions',
+                      'action': 'insert', 'id': question_id, 'previous': None,
+                      'record': {'id': question_id, 'question': 'Remote write',
+                                 'answer': 'Yes', 'category': 2,
+                                 'difficulty': 1}}
+            feed.publish([dict(remote, revision=1)])
+            self.assertEqual(question_index.count(art), count + 2)
+            self.assertNotEqual(
+                self.client().get('/api/v1/questions').headers['ETag'], etag)
+            self.assertEqual(len(published), 2)
+
+            # A lost event resets the caches, which reload from the database
+            feed.publish([dict(remote, revision=3, action='delete')])
+            self.assertEqual(question_index.count(art), count + 2)
+        finally:
+            change_feed.detach()
+
+    def test_bank_revision_is_shared_by_workers(self):
+        workers = [BankRevision(), BankRevision()]
+        etag = workers[0].etag()
+        self.assertEqual(workers[1].etag(), etag)
+
+        question = Question(question='Shared revision', answer='Yes',
+                            category=1, difficulty=1)
+        question.insert()
+        # The second worker hears of the write from the change feed
+        workers[1].bump()
+        self.assertEqual(workers[0].etag(), etag)
+        workers[0].bump()
+        self.assertNotEqual(workers[0].etag(), etag)
+        self.assertEqual(workers[0].etag(), workers[1].etag())
+        self.assertEqual(BankRevision().etag(), workers[1].etag())
+
+    def test_change_feed_defaults_to_postgres(self):
+        feed = change_feed.feed_from_environment(self.database_path,
+                                                 environ={})
+        self.assertIsInstance(feed, change_feed.PostgresChangeFeed)
+        self.assertEqual(feed.channel, change_feed.DEFAULT_CHANNEL)
+        self.assertIsNone(change_feed.feed_from_environment(
+            self.database_path, environ={'TRIVIA_CHANGE_FEED': 'none'}))
+        self.assertIsNone(change_feed.feed_from_environment(
+            'sqlite:///trivia.db', environ={}))
+        self.assertIs(type(change_feed.feed_from_environment(
+            'sqlite:///trivia.db', environ={'TRIVIA_CHANGE_FEED': 'local'})),
+            change_feed.ChangeFeed)
+
+    def test_postgres_change_feed_delivers_notifications(self):
+        feed = change_feed.PostgresChangeFeed('trivia_test_changes')
+        received = []
+        delivered = threading.Event()
+
+        def receive(events):
+            received.extend(events)
+            if any(event['origin'] == 'test' for event in events):
+                delivered.set()
+
+        feed.subscribe(receive)
+        feed.start(self.app)
+        try:
+            feed.publish([
+                {'origin': 'test', 'revision': 1, 'table': 'questions',
+                 'action': 'update', 'id': 1, 'previous': None,
+                 'record': {'id': 1, 'question': 'x' * 10000}},
+                {'origin': 'test', 'revision': 2, 'table': 'categories',
+                 'action': 'delete', 'id': 1, 'previous': None,
+                 'record': {'id': 1, 'type': 'Science'}},
+            ])
+            self.assertTrue(delivered.wait(10))
+        finally:
+            feed.stop()
+
+        self.assertEqual(received[0]['action'], 'reset')
+        events = [event for event in received if event['origin'] == 'test']
+        self.assertEqual([event['revision'] for event in events], [1, 2])
+        self.assertIsNone(events[0]['record'])
+        self.assertEqual(events[1]['record'], {'id': 1, 'type': 'Science'})
+
+    def test_asgi_serves_the_same_routes(self):
+        app = AsgiApp(self.app, max_workers=2)
+
+        status, headers, body = asgi_request(app, 'GET', '/api/v1/categories')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-type'], 'application/json')
+        self.assertEqual(json.loads(body),
+                         json.loads(self.client().get('/api/v1/categories').data))
+
+        status, _, body = asgi_request(app, 'GET', '/api/v1/categories',
+                                       headers=[('If-None-Match',
+                                                 headers['etag'])])
+        self.assertEqual(status, 304)
+
+        status, _, body = asgi_request(app, 'GET', '/api/v1/questions',
+                                       query_string=b'page=1000')
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body)['success'], False)
+
+        payload = json.dumps({
+            'previous_questions': [],
+            'quiz_category': {'id': 1, 'type': 'Science'}
+        }).encode()
+        status, _, body = asgi_request(app, 'POST', '/api/v1/quizzes',
+                                       body=payload,
+                                       headers=[('Content-Type',
+                                                 'application/json'),
+                                                ('Content-Length',
+                                                 str(len(payload)))])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['question']['category'], 1)
+
+        # Chunked HTTP/1.1 and HTTP/2 requests carry no Content-Length
+        status, _, body = asgi_request(app, 'POST', '/api/v1/quizzes',
+                                       body=payload,
+                                       headers=[('Content-Type',
+                                                 'application/json')])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['question']['category'], 1)
+
+        status, _, body = asgi_request(app, 'GET', '/api/v1/questions/export')
+        self.assertEqual(status, 200)
+        with self.app.app_context():
+            self.assertEqual(len(body.splitlines()), Question.query.count())
+
+        # HTTP/2 servers send each cookie in a header of its own
+        environ = build_environ({'method': 'GET', 'path': '/', 'headers': [
+            (b'cookie', b'a=1'), (b'cookie', f'{PRIMARY_COOKIE}=1'.encode()),
+            (b'accept', b'text/plain'), (b'accept', b'application/json')
+        ]}, io.BytesIO())
+        self.assertEqual(environ['HTTP_COOKIE'], f'a=1; {PRIMARY_COOKIE}=1')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'text/plain,application/json')
+        self.assertEqual(environ['CONTENT_LENGTH'], '0')
+
+        # Mounted under a root path, which the ASGI path starts with
+        environ = build_environ({'method': 'GET', 'root_path': '/trivia',
+                                 'path': '/trivia/api/v1/categories'},
+                                io.BytesIO())
+        self.assertEqual(environ['SCRIPT_NAME'], '/trivia')
+        self.assertEqual(environ['PATH_INFO'], '/api/v1/categories')
+
+        app.executor.shutdown()
+
     def test_start_quiz_category_not_found(self):
         payload = {
             'previous_questions': [],
@@ -189,6 +1622,24 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
 
 
+
+class AsgiTriviaTestCase(TriviaTestCase):
+    """Runs every trivia test case again, with the requests of self.client
+    served through AsgiApp"""
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.asgi_app = AsgiApp(cls.app, max_workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.asgi_app.executor.shutdown()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.client = lambda: AsgiClient(self.asgi_app)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()